@@ -1,10 +1,26 @@
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import socket
+import threading
 import time
-from collections import namedtuple
+import warnings
+import weakref
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
 
 import numpy as np
 import scipy
-from networkx import DiGraph, dfs_successors, balanced_tree, path_graph
+import scipy.sparse
 from sklearn.metrics import pairwise_kernels
 
 
@@ -16,10 +32,21 @@ class SampleDict(object):
     """A collection of samples, together with their reweighting constants
        and other information necessary to build a nystrom reconstruction
 
+    A dictionary can either store its samples in X, or only store their indices idx in a source matrix shared by all
+    dictionaries (index mode, X is None). In index mode the rows are gathered from the source only when the kernel is
+    evaluated, so that dictionaries stay small in memory and cheap to transfer. Since the source is referenced and not
+    copied, index mode is meant for executors that share memory with the caller, or for sources that can be
+    transferred by reference.
+
     Attributes
     ----------
-    X : array, shape (q, n_features)
+    X : array or sparse matrix, shape (q, n_features) or None
         Samples included in the dictionary. Also known as inducing points, support vectors or anchor points.
+        None in index mode. Sparse if the input samples are, see as_input.
+    idx : array, shape (q,) or None
+        Indices of the samples in the input dataset.
+    source : array, shape (n, n_features) or None
+        The input dataset the samples are gathered from in index mode.
     probs : array, shape (q,)
         The inclusion probability of each sample, used for coin flipping and reweighting.
     q_i : array, shape (q,)
@@ -31,15 +58,247 @@ class SampleDict(object):
         The regularization parameter used to compute the Ridge Leverage Scores.
     vareps : float
         The accuracy parameter used to compute the Ridge Leverage Scores.
+    K : array, shape (q, q) or None
+        The (unweighted) kernel matrix between the samples in the dictionary, if it was kept after the merge that
+        produced the dictionary. It allows the next merge to only evaluate the kernel between the two dictionaries.
+    merge_stats : mapping of string to any or None
+        Timings and sizes recorded by the merge that produced the dictionary, see MergeMetrics.
     """
 
-    def __init__(self, X, probs, q_i, qbar, gamma, vareps):
+    # dictionaries are created for every merge and potentially kept alive for the whole run, so we get rid of the
+    # per instance __dict__
+    __slots__ = ('X', 'idx', 'source', 'probs', 'q_i', 'qbar', 'gamma', 'vareps', 'K', 'merge_stats')
+
+    def __init__(self, X, probs, q_i, qbar, gamma, vareps, K=None, idx=None, source=None):
         self.X = X
+        self.idx = idx
+        self.source = source
         self.probs = probs
         self.q_i = q_i
         self.gamma = gamma
         self.vareps = vareps
         self.qbar = qbar
+        self.K = K
+        self.merge_stats = None
+
+        # in index mode we need to know where to gather the samples from
+        assert X is not None or (idx is not None and source is not None)
+
+    def get_X(self):
+        """Returns the samples included in the dictionary, gathering them from the source in index mode.
+
+        Returns
+        -------
+        X : array, shape (q, n_features)
+            Samples included in the dictionary.
+        """
+        if self.X is not None:
+            return self.X
+        return gather_rows(self.source, self.idx)
+
+    def detach(self):
+        """Stores the samples in X, gathering them from the source in index mode, and drops the reference to the
+        source while keeping idx. The dictionaries returned to the caller are detached, so that they stay valid (and
+        can be pickled) after the input shared with the workers is released, see share_input.
+
+        Returns
+        -------
+        self : SampleDict
+            The dictionary, modified in place.
+        """
+        self.X = self.get_X()
+        self.source = None
+        return self
+
+
+class MemmapArray(object):
+    """A read-only memory-mapped array stored on disk. When pickled only its file name and layout are transferred, and
+    the file is mapped again lazily, so that other processes (or machines sharing the file system) read the samples
+    from disk instead of receiving a copy. It supports the subset of the array interface needed to gather samples
+    (shape, dtype, len and indexing).
+
+    Attributes
+    ----------
+    filename : string
+        Path of the file containing the array.
+    dtype : numpy.dtype
+        Type of the array.
+    shape : tuple of int
+        Shape of the array.
+    offset : int
+        Offset in bytes of the array in the file.
+    order : string
+        Memory layout of the array, either 'C' or 'F'.
+    """
+
+    def __init__(self, filename, dtype, shape, offset=0, order='C'):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.offset = offset
+        self.order = order
+        self._array = None
+
+    @classmethod
+    def from_memmap(cls, X):
+        """Creates a handle to the same file mapped by a np.memmap.
+
+        Parameters
+        ----------
+        X : np.memmap
+            The mapped array, must map a whole file region (not be a view of another memmap).
+
+        Returns
+        -------
+        handle : MemmapArray
+            The handle to the file.
+        """
+        assert isinstance(X.base, mmap.mmap)
+        order = 'F' if X.flags.f_contiguous and not X.flags.c_contiguous else 'C'
+        return cls(X.filename, X.dtype, X.shape, offset=X.offset, order=order)
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape, offset=self.offset,
+                                    order=self.order)
+        return self._array
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __reduce__(self):
+        return MemmapArray, (self.filename, self.dtype.str, self.shape, self.offset, self.order)
+
+
+def as_input(X):
+    """Converts the supported input formats to an array-like object that can be used by visit_merge_tree.
+
+    Parameters
+    ----------
+    X : array, np.memmap, string or array-like, shape (n, n_features)
+        Input samples. A string is interpreted as the path of a .npy file, which is memory-mapped and never loaded
+        entirely. A np.memmap is converted to a MemmapArray, so that it can be sent to other processes by reference.
+        Any other object with a shape attribute that supports indexing with a sorted array of row indices (e.g. a HDF5
+        dataset), or a zarr-style orthogonal index (oindex), is returned unchanged. Note that these objects are
+        usually not picklable, and can only be used with executors that share memory with the caller. Sparse matrices
+        are converted to CSR, so that rows can be gathered efficiently, and the dictionaries stay sparse.
+
+    Returns
+    -------
+    X : array-like, shape (n, n_features)
+        The input samples.
+    """
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode='r')
+
+    if scipy.sparse.issparse(X):
+        return X.tocsr()
+
+    if isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap):
+        return MemmapArray.from_memmap(X)
+
+    return X
+
+
+def gather_rows(X, idx):
+    """Gathers a subset of rows from the input samples. Inputs that are not in memory are read in increasing order of
+    index, so that reads from disk are sequential.
+
+    Parameters
+    ----------
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input.
+    idx : array, shape (q,)
+        Indices of the rows to gather.
+
+    Returns
+    -------
+    X_idx : array or sparse matrix, shape (q, n_features)
+        The rows of X in the order given by idx, sparse if X is.
+    """
+    if type(X) is np.ndarray or scipy.sparse.issparse(X):
+        return X[idx]
+
+    order = np.argsort(idx, kind='stable')
+    sorted_idx = idx[order]
+
+    if hasattr(X, 'oindex'):
+        X_sorted = X.oindex[sorted_idx, :]
+    else:
+        X_sorted = X[sorted_idx]
+
+    # samples were already in order (e.g. leaves), nothing to undo
+    if (order[1:] > order[:-1]).all():
+        return X_sorted
+
+    if scipy.sparse.issparse(X_sorted):
+        return X_sorted[np.argsort(order)]
+
+    X_idx = np.empty_like(X_sorted)
+    X_idx[order] = X_sorted
+    return X_idx
+
+
+def dict_nbytes(d):
+    """Returns the size in bytes of the arrays stored in a dictionary, an estimate of the cost of transferring it. In
+    index mode the source is not included, since it is shared.
+
+    Parameters
+    ----------
+    d : SampleDict
+        The dictionary.
+
+    Returns
+    -------
+    nbytes : int
+        The size of the arrays.
+    """
+    return sum(array_nbytes(array) for array in (d.X, d.idx, d.probs, d.q_i, d.K) if array is not None)
+
+
+def array_nbytes(X):
+    """Returns the size in bytes of an array, or of the arrays storing a sparse matrix."""
+    if scipy.sparse.issparse(X):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return X.nbytes
+
+
+def leaf_dict(X, leaf_assigned_samples, exp_options, index_dicts=False):
+    """Creates the dictionary of a leaf, containing all assigned samples with multiplicity qbar and probability 1.
+    These initialization dictionaries are guaranteed to be accurate since they simply store all samples.
+
+    Parameters
+    ----------
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input.
+    leaf_assigned_samples : array, shape (n_i,)
+        Indices of the samples assigned to the leaf.
+    exp_options : mapping of string to any
+        Dictionary containing the experiment options, see visit_merge_tree.
+    index_dicts : bool (optional, default=False)
+        Whether to create the dictionary in index mode, referencing X instead of copying the samples.
+
+    Returns
+    -------
+    d : SampleDict
+        The leaf dictionary.
+    """
+    n_i = leaf_assigned_samples.shape[0]
+    qbar = int(np.round(exp_options['qbar']))
+
+    if index_dicts:
+        # the number of copies never exceeds qbar, and indices never exceed n, use the smallest types that fit them
+        return SampleDict(X=None, idx=leaf_assigned_samples.astype(np.min_scalar_type(X.shape[0] - 1)), source=X,
+                          probs=np.ones(n_i), q_i=np.full(n_i, qbar, dtype=np.min_scalar_type(qbar)),
+                          qbar=qbar, gamma=float(exp_options['gamma']), vareps=float(exp_options['vareps']))
+
+    return SampleDict(X=gather_rows(X, leaf_assigned_samples), idx=leaf_assigned_samples,
+                      probs=np.ones(n_i), q_i=np.ones(n_i, dtype=int) * qbar,
+                      qbar=qbar, gamma=float(exp_options['gamma']), vareps=float(exp_options['vareps']))
 
 
 class MergePromise(namedtuple('MergePromise', ('is_finished', 'result'))):
@@ -63,13 +322,457 @@ class MergePromise(namedtuple('MergePromise', ('is_finished', 'result'))):
     __slots__ = ()
 
 
-def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True):
+class FuturePromise(object):
+    """Wraps a concurrent.futures.Future to satisfy the MergePromise interface.
+
+    Attributes
+    ----------
+    future : concurrent.futures.Future
+        The wrapped future.
+    """
+    __slots__ = ('future',)
+
+    def __init__(self, future):
+        self.future = future
+
+    @property
+    def is_finished(self):
+        return self.future.done()
+
+    @property
+    def result(self):
+        return self.future.result()
+
+    def add_done_callback(self, fn):
+        # the executor invokes the callback with its own future, pass our wrapper instead
+        self.future.add_done_callback(lambda _: fn(self))
+
+    @property
+    def is_running(self):
+        return self.future.running()
+
+    def cancel(self):
+        # a merge that already started cannot be interrupted, and will run to completion
+        self.future.cancel()
+
+
+class ProcessPromise(FuturePromise):
+    """Wraps a concurrent.futures.Future of a ProcessPoolExecutor. The executor marks a task as running as soon as it
+    is queued for a worker, before any worker picks it, so the workers notify when they actually start a task instead,
+    see run_process_task.
+
+    Attributes
+    ----------
+    future : concurrent.futures.Future
+        The wrapped future.
+    task_id : int
+        Identifier of the task, sent by the worker that starts it.
+    started_tasks : set of int
+        The identifiers of the tasks started by the workers, shared by all the promises of the executor.
+    """
+    __slots__ = ('task_id', 'started_tasks')
+
+    def __init__(self, future, task_id, started_tasks):
+        super(ProcessPromise, self).__init__(future)
+        self.task_id = task_id
+        self.started_tasks = started_tasks
+        # the task is forgotten once it completes
+        future.add_done_callback(lambda _: started_tasks.discard(task_id))
+
+    @property
+    def is_running(self):
+        return self.task_id in self.started_tasks and not self.future.done()
+
+
+# the queue used by the worker processes to notify the tasks they start, see init_process_worker
+_task_start_queue = None
+
+
+def init_process_worker(task_start_queue):
+    """Initializes a worker process of the 'processes' backend, see get_rpc_invoker.
+
+    Parameters
+    ----------
+    task_start_queue : multiprocessing.Queue
+        The queue where the worker notifies the tasks it starts.
+    """
+    global _task_start_queue
+    _task_start_queue = task_start_queue
+
+
+def run_process_task(task_id, func, *args):
+    """Notifies that a task is started, and runs it. This is the function executed by the workers of the 'processes'
+    backend, see ProcessPromise.
+
+    Parameters
+    ----------
+    task_id : int
+        Identifier of the task.
+    func : callable
+        The function to run.
+    args : any
+        The arguments of func.
+
+    Returns
+    -------
+    result : any
+        The result of func.
+    """
+    _task_start_queue.put(task_id)
+    return func(*args)
+
+
+class SharedArray(object):
+    """A read-only array stored in shared memory. When pickled only its name, shape and type are transferred, and
+    other processes on the same machine attach to the same memory instead of receiving a copy. It supports the subset
+    of the array interface needed to gather samples (shape, dtype, len and indexing).
+
+    The array is released when the SharedArray created by from_array is garbage collected, so the caller must keep it
+    alive for as long as other processes may attach to it.
+
+    Attributes
+    ----------
+    shape : tuple of int
+        Shape of the array.
+    dtype : numpy.dtype
+        Type of the array.
+    """
+
+    def __init__(self, shm, shape, dtype):
+        self._shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        self.array.flags.writeable = False
+
+    @classmethod
+    def from_array(cls, X):
+        """Copies an array into a new shared memory block.
+
+        Parameters
+        ----------
+        X : array
+            The array to share.
+
+        Returns
+        -------
+        shared : SharedArray
+            The owner of the shared memory block.
+        """
+        from multiprocessing.shared_memory import SharedMemory
+
+        X = np.asarray(X)
+        # shared memory blocks cannot be empty
+        shm = SharedMemory(create=True, size=max(X.nbytes, 1))
+        np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[...] = X
+
+        shared = cls(shm, X.shape, X.dtype)
+        weakref.finalize(shared, _release_shared_memory, shm)
+        return shared
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __reduce__(self):
+        return _attach_shared_array, (self._shm.name, self.shape, self.dtype.str)
+
+
+def _attach_shared_array(name, shape, dtype):
+    from multiprocessing.shared_memory import SharedMemory
+
+    try:
+        # only the owner should track (and eventually unlink) the block
+        shm = SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always tracks attached blocks
+        shm = SharedMemory(name=name)
+    return SharedArray(shm, shape, dtype)
+
+
+def _release_shared_memory(shm):
+    shm.close()
+    shm.unlink()
+
+
+class SharedCSRMatrix(object):
+    """A read-only CSR matrix stored in shared memory, the sparse counterpart of SharedArray. The three arrays of the
+    CSR format are SharedArrays, and rows are gathered by indexing a scipy.sparse.csr_matrix that references them.
+
+    Attributes
+    ----------
+    shape : tuple of int
+        Shape of the matrix.
+    """
+
+    def __init__(self, data, indices, indptr, shape):
+        self._arrays = (data, indices, indptr)
+        self.shape = tuple(shape)
+        self.matrix = scipy.sparse.csr_matrix((data.array, indices.array, indptr.array), shape=self.shape, copy=False)
+
+    @classmethod
+    def from_csr(cls, X):
+        """Copies a CSR matrix into new shared memory blocks.
+
+        Parameters
+        ----------
+        X : scipy.sparse.csr_matrix
+            The matrix to share.
+
+        Returns
+        -------
+        shared : SharedCSRMatrix
+            The owner of the shared memory blocks.
+        """
+        return cls(SharedArray.from_array(X.data), SharedArray.from_array(X.indices),
+                   SharedArray.from_array(X.indptr), X.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.matrix[key]
+
+    def __reduce__(self):
+        return SharedCSRMatrix, self._arrays + (self.shape,)
+
+
+def share_with_processes(X):
+    """Makes the input samples available to other processes on the same machine without copies, see SharedArray and
+    SharedCSRMatrix. Inputs that are on disk can already be sent by reference, and are returned unchanged. Other
+    array-likes (e.g. HDF5 or zarr datasets) cannot be shared: they would have to be copied entirely in shared memory,
+    defeating their out-of-core storage, so None is returned instead.
+
+    Parameters
+    ----------
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input.
+
+    Returns
+    -------
+    X : array-like, shape (n, n_features), or None
+        The shared input samples, or None if X cannot be shared.
+    """
+    if isinstance(X, (MemmapArray, SharedArray, SharedCSRMatrix)):
+        return X
+    if scipy.sparse.issparse(X):
+        return SharedCSRMatrix.from_csr(X)
+    if isinstance(X, np.ndarray):
+        return SharedArray.from_array(X)
+    return None
+
+
+def compact_array(a):
+    """Converts an array to the smallest dtype that represents all its values exactly: non-negative integers to the
+    smallest unsigned type that holds their maximum, and floats to float32 if no value is rounded.
+
+    Parameters
+    ----------
+    a : array
+        The array to convert.
+
+    Returns
+    -------
+    a : array
+        The converted array, or the array itself if no smaller dtype is exact.
+    """
+    if a.size == 0:
+        return a
+
+    if np.issubdtype(a.dtype, np.integer):
+        if a.min() >= 0:
+            dtype = np.min_scalar_type(a.max())
+            if dtype.itemsize < a.dtype.itemsize:
+                return a.astype(dtype)
+    elif a.dtype == np.float64:
+        # float32 only covers a small fraction of the float64 values, and the check is cheap compared to a transfer
+        a32 = a.astype(np.float32)
+        if np.array_equal(a32, a):
+            return a32
+
+    return a
+
+
+def _rebuild_sample_dict(state):
+    d = SampleDict.__new__(SampleDict)
+    for key, value in state.items():
+        setattr(d, key, value)
+    return d
+
+
+class _WirePickler(pickle.Pickler):
+    """Pickler used by dumps_frames, it downcasts the arrays of the dictionaries it finds, see compact_array."""
+
+    def __init__(self, file, downcast, buffer_callback):
+        super(_WirePickler, self).__init__(file, protocol=5, buffer_callback=buffer_callback)
+        self.downcast = downcast
+
+    def reducer_override(self, obj):
+        if not self.downcast or type(obj) is not SampleDict:
+            return NotImplemented
+
+        state = {key: getattr(obj, key) for key in SampleDict.__slots__}
+        for key in ('idx', 'probs', 'q_i'):
+            if state[key] is not None:
+                state[key] = compact_array(state[key])
+        return _rebuild_sample_dict, (state,)
+
+
+def dumps_frames(obj, compress=False, downcast=True):
+    """Serializes an object containing dictionaries (e.g. the arguments or the result of a merge) for an rpc backend.
+    The object is pickled with protocol 5, so the contiguous numpy arrays (samples, kernel, weights) are not copied in
+    the pickle stream, but returned as separate out-of-band frames referencing their memory.
+
+    Parameters
+    ----------
+    obj : any
+        The object to serialize.
+    compress : bool or int (optional, default=False)
+        Whether to compress the frames with zlib, or the zlib compression level (True is level 1, the fastest).
+        A frame is only compressed if it gets smaller. Compression is lossless, but copies the frames.
+    downcast : bool (optional, default=True)
+        Whether to convert the indices, inclusion probabilities and copies of the dictionaries to the smallest dtype
+        that represents them exactly, see compact_array.
+
+    Returns
+    -------
+    header : mapping of string to any
+        Information needed to deserialize the frames, see loads_frames.
+    frames : list of bytes or memoryview
+        The pickle stream, followed by the out-of-band buffers.
+    """
+    buffers = []
+    stream = io.BytesIO()
+    _WirePickler(stream, downcast, buffers.append).dump(obj)
+    frames = [stream.getbuffer()] + [buffer.raw() for buffer in buffers]
+
+    compressed = [False] * len(frames)
+    if compress:
+        level = 1 if compress is True else compress
+        for i, frame in enumerate(frames):
+            compressed_frame = zlib.compress(frame, level)
+            if len(compressed_frame) < frame.nbytes:
+                frames[i] = compressed_frame
+                compressed[i] = True
+
+    return {'wire_compressed': compressed}, frames
+
+
+def loads_frames(header, frames):
+    """Deserializes an object serialized by dumps_frames. The arrays reference the memory of the frames, so they are
+    read-only if the frames are.
+
+    Parameters
+    ----------
+    header : mapping of string to any
+        The header returned by dumps_frames.
+    frames : list of bytes-like
+        The frames returned by dumps_frames.
+
+    Returns
+    -------
+    obj : any
+        The deserialized object.
+    """
+    frames = [zlib.decompress(frame) if compressed else frame
+              for frame, compressed in zip(frames, header['wire_compressed'])]
+    return pickle.loads(frames[0], buffers=frames[1:])
+
+
+class WireSerializer(object):
+    """Serializer for redis-queue jobs, see dumps_frames. The frames are packed in a single bytes object, preceded by
+    a json header containing their sizes. The header also records how each frame was compressed, so a worker can load
+    the jobs of any client. Start the workers with 'rq worker --serializer squeak.wire_serializer'.
+
+    Parameters
+    ----------
+    compress : bool or int (optional, default=False)
+        See dumps_frames.
+    downcast : bool (optional, default=True)
+        See dumps_frames.
+    """
+
+    def __init__(self, compress=False, downcast=True):
+        self.compress = compress
+        self.downcast = downcast
+
+    def dumps(self, obj):
+        header, frames = dumps_frames(obj, compress=self.compress, downcast=self.downcast)
+        header['wire_sizes'] = [memoryview(frame).nbytes for frame in frames]
+        header = json.dumps(header).encode()
+        return b''.join([len(header).to_bytes(8, 'little'), header] + frames)
+
+    def loads(self, data):
+        data = memoryview(data)
+        header_end = 8 + int.from_bytes(data[:8], 'little')
+        header = json.loads(bytes(data[8:header_end]))
+
+        frames = []
+        frame_start = header_end
+        for size in header['wire_sizes']:
+            frames.append(data[frame_start:frame_start + size])
+            frame_start = frame_start + size
+
+        return loads_frames(header, frames)
+
+
+# used by the redis-queue workers, see WireSerializer
+wire_serializer = WireSerializer()
+
+
+def register_dask_serialization(compress=False, downcast=True):
+    """Registers dumps_frames as the dask serialization of SampleDict. It must be called both on the client and on the
+    workers, see get_rpc_invoker.
+
+    Parameters
+    ----------
+    compress : bool or int (optional, default=False)
+        See dumps_frames.
+    downcast : bool (optional, default=True)
+        See dumps_frames.
+    """
+    from distributed.protocol import dask_deserialize, dask_serialize
+
+    @dask_serialize.register(SampleDict)
+    def serialize_sample_dict(d):
+        return dumps_frames(d, compress=compress, downcast=downcast)
+
+    @dask_deserialize.register(SampleDict)
+    def deserialize_sample_dict(header, frames):
+        return loads_frames(header, frames)
+
+
+def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True, n_workers=None,
+                    wire_options=None):
     """Returns an invoker that satisfies the signature rpc_invoker(merge_function, **merge_args) -> MergePromise.
     The actual implementation depends on the backend and can be replaced if necessary.
-    The currently implemented backends are based on dask.distributed or redis and redis-queue.
+    The currently implemented backends are based on dask.distributed or redis and redis-queue, or on a local pool of
+    processes or threads.
     If the url is 'localhost' and async_eval is False, it will return a local executor without the need of installing
     any backend.
 
+    The 'processes' and 'threads' backends do not need any server and use all cores of the local machine. The kernel
+    and linear algebra routines release the GIL, so threads are often enough and avoid transferring dictionaries.
+    Their invokers also expose a share_input(X) method, used by visit_merge_tree to give workers access to the input
+    samples without copies (see share_with_processes for processes, X itself for threads), so that dictionaries in
+    index mode only transfer indices. share_input returns None for inputs that cannot be shared.
+
+    The 'processes', 'threads' and 'dask' invokers expose a shutdown() method that releases their workers (or their
+    connection to the cluster). squeak, disqueak and iter_squeak_stream call it on the invokers they create.
+
+    Invokers may expose an n_workers attribute, the number of tasks they can run at once, and the 'dask' invoker a
+    share_object(obj) method that sends obj to all workers once, returning a reference that can be passed to the tasks
+    in its place.
+
+    The 'redis' and 'dask' backends send the dictionaries in a compact wire format, see dumps_frames: arrays are
+    transferred as out-of-band buffers, optionally compressed, and the weights are downcast when it is lossless. This
+    includes the dictionaries nested in lists of arguments (e.g. the inputs of merge_subtree), while other arguments
+    (e.g. the slices of X scored by RLSEstimator.score) use the default serialization of the backend. The
+    redis-queue workers must use the same serializer ('rq worker --serializer squeak.wire_serializer'), while the
+    dask workers currently connected to the scheduler are configured by the invoker.
+
     Parameters
     ----------
     backend : string (optional, default='redis')
@@ -81,6 +784,10 @@ def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True
     async_eval : bool (optional, default=True)
         Whether the execution should be delayed or not. Set to False to force sequential execution or for
         debugging purposes.
+    n_workers : int (optional, default=None)
+        Number of workers of the 'processes' and 'threads' backends. If None, the number of cores.
+    wire_options : mapping of string to any (optional, default=None)
+        Keyword arguments of dumps_frames ('compress' and 'downcast') used by the 'redis' and 'dask' backends.
 
     Returns
     -------
@@ -103,10 +810,11 @@ def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True
 
             task_queue = Queue(
                 connection=Redis(url, port, password="yourpasswordhere"),
-                async=async_eval)
+                is_async=async_eval,
+                serializer=WireSerializer(**(wire_options or {})))
 
             def call_rpc_function(func, *args):
-                return task_queue.enqueue(func, *args, timeout=86400)
+                return task_queue.enqueue(func, *args, job_timeout=86400)
 
             return call_rpc_function
         elif backend == 'dask':
@@ -115,6 +823,40 @@ def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True
             # almost arbitrary code to run. Add TLS (but user needs to know how to use it)
             client = Client("{}:{}".format(url, port))
 
+            # the workers serialize the merged dictionaries they send back, so they need the same registration
+            register_dask_serialization(**(wire_options or {}))
+            client.run(register_dask_serialization, **(wire_options or {}))
+
+            def scatter_dicts(args):
+                # dask applies custom serializations to the data it scatters, while task arguments are pickled. The
+                # workers resolve futures nested in lists, so the dictionaries are scattered wherever they appear in
+                # the (possibly nested) lists of arguments, e.g. the inputs of merge_subtree or of a sweep
+                dicts = []
+
+                def find_dicts(arg):
+                    if isinstance(arg, SampleDict):
+                        dicts.append(arg)
+                    elif isinstance(arg, list):
+                        for item in arg:
+                            find_dicts(item)
+
+                for arg in args:
+                    find_dicts(arg)
+                if not dicts:
+                    return list(args)
+
+                # a single call for all the dictionaries of the task
+                futures = iter(client.scatter(dicts, hash=False))
+
+                def replace_dicts(arg):
+                    if isinstance(arg, SampleDict):
+                        return next(futures)
+                    elif isinstance(arg, list):
+                        return [replace_dicts(item) for item in arg]
+                    return arg
+
+                return [replace_dicts(arg) for arg in args]
+
             def call_rpc_function(func, *args):
                 class DaskPromise(object):
                     def __init__(self, dask_promise):
@@ -126,12 +868,79 @@ def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True
 
                     @property
                     def result(self):
-                        try:
-                            return self.dask_promise.result(timeout=10)
-                        except TimeoutError:
-                            return None
+                        return self.dask_promise.result()
+
+                    @property
+                    def is_running(self):
+                        # the scheduler lists the tasks that each worker is processing
+                        return any(self.dask_promise.key in keys for keys in client.processing().values())
+
+                    def add_done_callback(self, fn):
+                        # dask invokes the callback with its own future, pass our wrapper instead
+                        self.dask_promise.add_done_callback(lambda _: fn(self))
+
+                    def cancel(self):
+                        self.dask_promise.cancel()
+
+                # dask identifies pure tasks by their arguments, so a speculative copy of a merge (see
+                # visit_merge_tree) would be deduplicated with the original
+                return DaskPromise(client.submit(func, *scatter_dicts(args), pure=False))
 
-                return DaskPromise(client.submit(func, *args))
+            # objects used by many tasks (e.g. an RLSEstimator) are sent once to every worker, and the tasks only
+            # receive a reference to them
+            call_rpc_function.share_object = lambda obj: client.scatter(obj, broadcast=True, hash=False)
+            call_rpc_function.shutdown = client.close
+            call_rpc_function.n_workers = sum(worker['nthreads']
+                                              for worker in client.scheduler_info()['workers'].values())
+
+            return call_rpc_function
+
+        elif backend == 'processes' or backend == 'threads':
+            if n_workers is None:
+                n_workers = os.cpu_count()
+
+            if backend == 'processes':
+                # the workers notify the tasks they start, collected by a background thread, see ProcessPromise
+                task_start_queue = multiprocessing.Queue()
+                started_tasks = set()
+                task_ids = itertools.count()
+
+                def collect_started_tasks():
+                    # None is sent by shutdown
+                    for task_id in iter(task_start_queue.get, None):
+                        started_tasks.add(task_id)
+
+                collector = threading.Thread(target=collect_started_tasks, daemon=True)
+                collector.start()
+                executor = ProcessPoolExecutor(max_workers=n_workers, initializer=init_process_worker,
+                                               initargs=(task_start_queue,))
+
+                def call_rpc_function(func, *args):
+                    task_id = next(task_ids)
+                    return ProcessPromise(executor.submit(run_process_task, task_id, func, *args), task_id,
+                                          started_tasks)
+            else:
+                executor = ThreadPoolExecutor(max_workers=n_workers)
+
+                def call_rpc_function(func, *args):
+                    return FuturePromise(executor.submit(func, *args))
+
+            def shutdown():
+                # do not wait for the copies of straggling merges that were abandoned, the workers exit once their
+                # current task is done
+                executor.shutdown(wait=False, cancel_futures=True)
+                if backend == 'processes':
+                    task_start_queue.put(None)
+                    collector.join()
+                    task_start_queue.close()
+                    task_start_queue.join_thread()
+
+            call_rpc_function.shutdown = shutdown
+            call_rpc_function.n_workers = n_workers
+            if backend == 'processes':
+                call_rpc_function.share_input = share_with_processes
+            else:
+                call_rpc_function.share_input = lambda X: X
 
             return call_rpc_function
 
@@ -140,40 +949,365 @@ def get_rpc_invoker(backend='redis', url='localhost', port=6379, async_eval=True
 
 
 
-def dict_merge(d_left, d_right, kernel_options, random_state):
-    """Merges two dictionaries, and performs a rejection sampling step according to the new RLS
-    to discard redundant samples.
+class PromiseWatcher(object):
+    """Tracks a set of running promises, and reports them as they finish. Promises that expose an
+    add_done_callback(fn) method notify their completion directly, all others are polled every poll_interval seconds.
 
     Parameters
     ----------
-    d_left : SampleDict
-        The first dictionary to merge (from left descendent).
-    d_right : SampleDict
-        The second dictionary to merge (from right descendent).
-    kernel_options : mapping of string to any
-        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
-    random_state : RandomState !!MODIFIED!!
-        RandomState instance used as the random number generator
+    poll_interval : float (optional, default=0.5)
+        Seconds to wait between two checks of promises that do not support completion callbacks.
+    """
+
+    def __init__(self, poll_interval=0.5):
+        self.poll_interval = poll_interval
+        # completion callbacks can be invoked from other threads, so they communicate through a synchronized queue
+        self._notified = queue.Queue()
+        # running promises that do not support callbacks, and that need to be checked periodically
+        self._polled = {}
+        # keys that are no longer tracked, but whose promise may still notify its completion
+        self._discarded = set()
+        self._n_running = 0
+
+    def __len__(self):
+        return self._n_running
+
+    def watch(self, key, promise):
+        """Starts tracking a promise.
+
+        Parameters
+        ----------
+        key : any
+            Identifier reported by wait once the promise is finished.
+        promise : MergePromise
+            The promise.
+        """
+        self._n_running = self._n_running + 1
+        if hasattr(promise, 'add_done_callback'):
+            promise.add_done_callback(lambda _: self._notified.put(key))
+        else:
+            self._polled[key] = promise
+
+    def discard(self, key):
+        """Stops tracking a promise, which will not be reported by wait.
+
+        Parameters
+        ----------
+        key : any
+            Identifier of the promise, as passed to watch.
+        """
+        self._n_running = self._n_running - 1
+        if key in self._polled:
+            del self._polled[key]
+        else:
+            self._discarded.add(key)
+
+    def _notification(self, key, keys):
+        if key in self._discarded:
+            self._discarded.remove(key)
+        else:
+            keys.append(key)
+
+    def wait(self, timeout=None):
+        """Blocks until at least one of the tracked promises is finished, or until the timeout expires.
+
+        Parameters
+        ----------
+        timeout : float (optional, default=None)
+            Maximum number of seconds to wait. If None, wait until a promise is finished.
+
+        Returns
+        -------
+        keys : list
+            The keys of all promises that finished since the last call, possibly empty if the timeout expired.
+        """
+        keys = []
+        deadline = None if timeout is None else time.time() + timeout
+
+        while not keys:
+            # if no promise needs polling, all running promises will notify us
+            wait_time = self.poll_interval if self._polled else None
+            if deadline is not None:
+                time_left = max(0., deadline - time.time())
+                wait_time = time_left if wait_time is None else min(wait_time, time_left)
+
+            try:
+                self._notification(self._notified.get(timeout=wait_time), keys)
+            except queue.Empty:
+                pass
+
+            for key in [key for key, promise in self._polled.items() if promise.is_finished]:
+                del self._polled[key]
+                keys.append(key)
+
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        # collect any other notification that arrived in the meantime
+        while True:
+            try:
+                self._notification(self._notified.get_nowait(), keys)
+            except queue.Empty:
+                break
+
+        self._n_running = self._n_running - len(keys)
+        return keys
+
+
+def promise_started(promise):
+    """Checks whether the computation of a promise was started by a worker, as opposed to waiting in a queue.
+
+    Parameters
+    ----------
+    promise : MergePromise
+        The promise. Promises that expose an is_running property (see FuturePromise, ProcessPromise and the dask
+        invoker) or an is_started one (redis-queue jobs) are queried, all others are considered started as soon as
+        they are created.
 
     Returns
     -------
-    d_top : SampleDict
-        The result of the merge.
+    started : bool
+        Whether the computation started, or finished.
     """
+    if promise.is_finished:
+        return True
+    if hasattr(promise, 'is_running'):
+        return promise.is_running
+    if hasattr(promise, 'is_started'):
+        return promise.is_started
+    return True
 
-    # create a temporary dictionary as the concatenation of the two inputs
-    d_top = SampleDict(X=np.concatenate((d_left.X, d_right.X)),
-                       probs=np.concatenate((d_left.probs, d_right.probs)),
-                       q_i=np.concatenate((d_left.q_i, d_right.q_i)), qbar=d_left.qbar, gamma=d_left.gamma,
-                       vareps=d_left.vareps)
 
-    # estimate RLS
-    tau = estimate_tau(d_top, kernel_options)
+def wait_promise(promise, poll_interval=0.5):
+    """Blocks until a promise is finished, and returns its result.
 
-    # check for numerical problems
-    assert np.all(tau > np.finfo(float).eps)
+    Parameters
+    ----------
+    promise : MergePromise
+        The promise to wait for.
+    poll_interval : float (optional, default=0.5)
+        Seconds to wait between two checks, if the promise does not support completion callbacks.
 
-    # reject sample
+    Returns
+    -------
+    result : any
+        The result of the promise.
+    """
+    if not promise.is_finished:
+        if hasattr(promise, 'add_done_callback'):
+            done = threading.Event()
+            promise.add_done_callback(lambda _: done.set())
+            done.wait()
+        else:
+            while not promise.is_finished:
+                time.sleep(poll_interval)
+
+    return promise.result
+
+
+def new_merge_random_state(random_state):
+    """Creates the random number generator of a merge.
+
+    We cannot pass directly random_state to the rpc_invoker call, since the rpc could be executed on a remote
+    machine where modification to random_state do not propagate and compromise reproducibility.
+    Instead, we send over a reproducible random seed and expect the remote system to use it to initialize
+    a local reproducible rng.
+
+    Parameters
+    ----------
+    random_state : RandomState !!MODIFIED!!
+        RandomState instance used to draw the seed.
+
+    Returns
+    -------
+    merge_random_state : RandomState
+        RandomState instance to be sent to the merge.
+    """
+    return np.random.RandomState(
+        random_state.randint(np.iinfo(np.uint32).min + 10,
+                             high=np.iinfo(np.uint32).max - 10))
+
+
+def draw_merge_seeds(random_state, size):
+    """Draws in advance the seeds of several merges, see new_merge_random_state. The merge of node i in a MergeTree
+    uses np.random.RandomState(seeds[i]), so the seed of a merge does not depend on the order in which the merges are
+    scheduled, and a merge recomputed after a restart (see MergeCheckpoint) gets the same seed as in the original run.
+
+    Parameters
+    ----------
+    random_state : RandomState
+        RandomState instance used to draw the seeds.
+    size : int
+        Number of seeds to draw.
+
+    Returns
+    -------
+    seeds : np.array, shape (size,)
+        The seeds, one per merge.
+    """
+    return random_state.randint(np.iinfo(np.uint32).min + 10,
+                                high=np.iinfo(np.uint32).max - 10,
+                                size=size,
+                                dtype=np.int64)
+
+
+def dict_merge(d_left, d_right, kernel_options, random_state, merge_options=None):
+    """Merges two dictionaries, and performs a rejection sampling step according to the new RLS
+    to discard redundant samples.
+
+    Supported fields in merge_options are:
+    'tau_solver': The method used by estimate_tau to invert the regularized kernel matrix (default 'cholesky')
+    'cache_kernel': If True, the kernel matrix between the surviving samples is stored in the returned dictionary, and
+        the kernel blocks already stored in d_left and d_right are reused so that only the kernel between the two
+        dictionaries is evaluated. This trades q**2 memory (and transfer size) per dictionary for about half of the
+        kernel evaluations of each merge (default False)
+
+    Parameters
+    ----------
+    d_left : SampleDict
+        The first dictionary to merge (from left descendent).
+    d_right : SampleDict
+        The second dictionary to merge (from right descendent).
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+    random_state : RandomState !!MODIFIED!!
+        RandomState instance used as the random number generator
+    merge_options : mapping of string to any (optional, default=None)
+        Dictionary containing the options of the merge, see above.
+
+    Returns
+    -------
+    d_top : SampleDict
+        The result of the merge.
+    """
+    return dict_merge_many([d_left, d_right], kernel_options, random_state, merge_options)
+
+
+def dict_merge_many(dicts, kernel_options, random_state, merge_options=None):
+    """Merges any number of dictionaries in a single step, and performs a rejection sampling step according to the new
+    RLS to discard redundant samples. See dict_merge for more details, merging two dictionaries with dict_merge or
+    dict_merge_many gives the same result.
+
+    Parameters
+    ----------
+    dicts : list of SampleDict
+        The dictionaries to merge.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+    random_state : RandomState !!MODIFIED!!
+        RandomState instance used as the random number generator
+    merge_options : mapping of string to any (optional, default=None)
+        Dictionary containing the options of the merge, see dict_merge.
+
+    Returns
+    -------
+    d_top : SampleDict
+        The result of the merge.
+    """
+    if merge_options is None:
+        merge_options = {}
+
+    assert len(dicts) > 0
+
+    merge_stats = {'merge_start': time.time(),
+                   'worker': "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name),
+                   'kernel_time': 0.}
+    kernel_start = time.perf_counter()
+
+    # assemble the kernel matrix of the merged dictionary from the blocks of the inputs, the diagonal blocks are
+    # recomputed only if the inputs did not keep them (e.g. leaves)
+    K = None
+    if merge_options.get('cache_kernel', False):
+        bounds = np.cumsum([0] + [len(d.q_i) for d in dicts])
+        K = np.empty((bounds[-1], bounds[-1]))
+        for i, d_i in enumerate(dicts):
+            K[bounds[i]:bounds[i + 1], bounds[i]:bounds[i + 1]] = dict_kernel(d_i, kernel_options)
+            for j in range(i + 1, len(dicts)):
+                K[bounds[i]:bounds[i + 1], bounds[j]:bounds[j + 1]] = kernel_block(d_i.get_X(), dicts[j].get_X(),
+                                                                                   kernel_options)
+                # the kernel is symmetric
+                K[bounds[j]:bounds[j + 1], bounds[i]:bounds[i + 1]] = K[bounds[i]:bounds[i + 1],
+                                                                        bounds[j]:bounds[j + 1]].T
+        merge_stats['kernel_time'] = time.perf_counter() - kernel_start
+
+    # create a temporary dictionary as the concatenation of the inputs
+    d_top = concat_dicts(dicts, K=K)
+
+    # estimate RLS
+    tau = estimate_tau(d_top, kernel_options, solver=merge_options.get('tau_solver', 'cholesky'), stats=merge_stats)
+
+    rejection_start = time.perf_counter()
+    reject_samples(d_top, tau, random_state)
+
+    merge_stats['rejection_time'] = time.perf_counter() - rejection_start
+    merge_stats['merge_end'] = time.time()
+    d_top.merge_stats = merge_stats
+
+    return d_top
+
+
+def concat_dicts(dicts, K=None):
+    """Concatenates dictionaries, the first step of a merge. In index mode only the indices are concatenated and the
+    samples stay in the shared source.
+
+    Parameters
+    ----------
+    dicts : list of SampleDict
+        The dictionaries to concatenate.
+    K : array, shape (q, q) or None (optional, default=None)
+        The kernel matrix between all samples in the dictionaries, if already computed.
+
+    Returns
+    -------
+    d_top : SampleDict
+        The temporary dictionary, with the same qbar, gamma and vareps as the first input.
+    """
+    d_first = dicts[0]
+    index_mode = all(d.X is None for d in dicts)
+    has_idx = all(d.idx is not None for d in dicts)
+    return SampleDict(X=None if index_mode else stack_rows([d.get_X() for d in dicts]),
+                      idx=np.concatenate([d.idx for d in dicts]) if has_idx else None,
+                      source=d_first.source if index_mode else None,
+                      # the inputs may carry downcast probabilities (see compact_array), the new ones need float64
+                      probs=np.concatenate([d.probs for d in dicts]).astype(float, copy=False),
+                      q_i=np.concatenate([d.q_i for d in dicts]), qbar=d_first.qbar, gamma=d_first.gamma,
+                      vareps=d_first.vareps, K=K)
+
+
+def stack_rows(Xs):
+    """Stacks sets of samples vertically, as a CSR matrix if any of them is sparse.
+
+    Parameters
+    ----------
+    Xs : list of array or sparse matrix
+        The sets of samples.
+
+    Returns
+    -------
+    X : array or sparse matrix, shape (sum of q, n_features)
+        The stacked samples.
+    """
+    if any(scipy.sparse.issparse(X) for X in Xs):
+        return scipy.sparse.vstack(Xs, format='csr')
+    return np.concatenate(Xs)
+
+
+def reject_samples(d_top, tau, random_state):
+    """Performs the rejection sampling step of a merge, discarding the samples whose copies are all rejected.
+
+    Parameters
+    ----------
+    d_top : SampleDict !!MODIFIED!!
+        The temporary dictionary created by the merge, updated in place.
+    tau : array, shape (q,)
+        The RLS estimated for the samples in the dictionary, see estimate_tau.
+    random_state : RandomState !!MODIFIED!!
+        RandomState instance used as the random number generator
+    """
+    # check for numerical problems
+    assert np.all(tau > np.finfo(float).eps)
+
+    # reject sample
     for s in range(len(d_top.q_i)):
         # remember that to make the sampling well-defined, we need to take this minimum
         # it is always a legitimate operation, since increase in RLS can only be due to approximation error
@@ -184,80 +1318,1142 @@ def dict_merge(d_left, d_right, kernel_options, random_state):
     # non-zero returns a 1-tuple, extract the only elements
     survived_samples = np.nonzero(d_top.q_i)[0]
 
-    d_top.X = d_top.X[survived_samples]
+    if d_top.X is not None:
+        d_top.X = d_top.X[survived_samples]
+    if d_top.idx is not None:
+        d_top.idx = d_top.idx[survived_samples]
     d_top.probs = d_top.probs[survived_samples]
     d_top.q_i = d_top.q_i[survived_samples]
+    if d_top.K is not None:
+        d_top.K = d_top.K[np.ix_(survived_samples, survived_samples)]
+
+    q = d_top.q_i.shape[0]
+
+    assert d_top.X is None or d_top.X.shape[0] == q
+    assert d_top.idx is None or d_top.idx.shape == (q,)
+    assert d_top.q_i.shape == (q,)  # well, duh
+    assert d_top.probs.shape == (q,)
+
+    assert (d_top.q_i != 0).all()
+
+
+# the keys of kernel_options that configure how the kernel is evaluated, see kernel_block
+KERNEL_ENGINE_OPTIONS = ('kernel_engine', 'kernel_dtype', 'kernel_tile_memory', 'kernel_n_threads')
+
+# the kernels computed from the dot products of the samples, which sklearn accumulates in the precision of the samples
+DOT_PRODUCT_METRICS = ('linear', 'poly', 'polynomial', 'sigmoid', 'cosine')
+
+
+def split_kernel_options(kernel_options):
+    """Separates the options of the kernel engine (see kernel_block) from the parameters of the kernel function.
+
+    Parameters
+    ----------
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+
+    Returns
+    -------
+    engine_options : mapping of string to any
+        The options of the kernel engine.
+    metric_options : mapping of string to any
+        The kernel function and its parameters, passed to pairwise_kernels.
+    """
+    engine_options = {key: value for key, value in kernel_options.items() if key in KERNEL_ENGINE_OPTIONS}
+    metric_options = {key: value for key, value in kernel_options.items() if key not in KERNEL_ENGINE_OPTIONS}
+    return engine_options, metric_options
+
+
+def kernel_block(X, Y, kernel_options, lower=False):
+    """Evaluates the kernel between two sets of samples. Besides the kernel function and its parameters, passed to
+    sklearn's pairwise_kernels, kernel_options can contain the following keys to configure the evaluation:
+    'kernel_engine': 'sklearn' evaluates the whole block with a single call to pairwise_kernels, 'tiled' evaluates it
+        in tiles of rows, written directly in the output, so that the temporaries of pairwise_kernels are bounded by
+        'kernel_tile_memory' instead of growing with the block (default 'sklearn')
+    'kernel_dtype': The precision of the samples passed to pairwise_kernels. With 'float32' the samples are converted
+        before the evaluation, halving the memory read by the kernel, while the result is still stored in float64.
+        The euclidean distances of float32 samples are accumulated in float64 by sklearn (and returned in float32),
+        but the dot products are not: for the kernels in DOT_PRODUCT_METRICS the samples are converted back to float64
+        before the evaluation (the rows of X one tile at a time with the 'tiled' engine), so that only the samples are
+        rounded. Callable kernels receive the float32 samples (default 'float64')
+    'kernel_tile_memory': The memory in bytes used by the temporaries of each tile of the 'tiled' engine, each thread
+        evaluating one tile at a time (default 64 MiB)
+    'kernel_n_threads': The number of threads evaluating the tiles of the 'tiled' engine. The kernel functions
+        release the GIL, but also use a multithreaded BLAS (default 1)
+
+    Parameters
+    ----------
+    X : array or sparse matrix, shape (q_x, n_features)
+        First set of samples.
+    Y : array or sparse matrix, shape (q_y, n_features) or None
+        Second set of samples. If None, the kernel is evaluated between the samples in X.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+    lower : bool (optional, default=False)
+        If True and Y is None, the 'tiled' engine only evaluates the lower triangle (including the diagonal) of the
+        symmetric block, and the upper triangle is left to zero. Used when the block is only read by a Cholesky
+        factorization, see estimate_tau.
+
+    Returns
+    -------
+    K : array, shape (q_x, q_y)
+        The kernel matrix.
+    """
+    engine_options, metric_options = split_kernel_options(kernel_options)
+    engine = engine_options.get('kernel_engine', 'sklearn')
+    dtype = np.dtype(engine_options.get('kernel_dtype', 'float64'))
+
+    symmetric = Y is None
+    lower = lower and symmetric
+
+    # convert once, so that tiles are only views
+    if dtype != X.dtype:
+        X = X.astype(dtype)
+    if not symmetric and dtype != Y.dtype:
+        Y = Y.astype(dtype)
+
+    # the dot products of rounded samples are still accumulated in float64
+    upcast = dtype != np.float64 and metric_options.get('metric', 'linear') in DOT_PRODUCT_METRICS
+
+    if engine == 'sklearn':
+        if upcast:
+            X = X.astype(float)
+            Y = None if symmetric else Y.astype(float)
+        return pairwise_kernels(X, Y, **metric_options, filter_params=True).astype(float, copy=False)
+    elif engine == 'tiled':
+        if symmetric:
+            Y = X
+        if upcast:
+            Y = Y.astype(float)
+
+        n_x = X.shape[0]
+        n_y = Y.shape[0]
+        K = np.zeros((n_x, n_y)) if lower else np.empty((n_x, n_y))
+
+        # pairwise_kernels needs about two tile-sized temporaries (e.g. the distances and the kernel)
+        tile_rows = max(1, int(engine_options.get('kernel_tile_memory', 2 ** 26) // (2 * 8 * max(n_y, 1))))
+
+        def evaluate_tile(tile):
+            start, stop = tile
+            stop_y = stop if lower else n_y
+            X_tile = X[start:stop].astype(float) if upcast else X[start:stop]
+            K[start:stop, :stop_y] = pairwise_kernels(X_tile, Y[:stop_y], **metric_options, filter_params=True)
+
+        for_each_batch(evaluate_tile, iter_batches(n_x, tile_rows), n_jobs=engine_options.get('kernel_n_threads', 1))
+
+        return K
+    else:
+        raise NotImplementedError
+
+
+def dict_kernel(d, kernel_options):
+    """Returns the kernel matrix between the samples in a dictionary, reusing the one stored in the dictionary if any.
+
+    Parameters
+    ----------
+    d : SampleDict
+        The dictionary.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+
+    Returns
+    -------
+    K : array, shape (q, q)
+        The kernel matrix. If it comes from the dictionary it is not copied, and must not be modified.
+    """
+    if d.K is not None:
+        return d.K
+    return kernel_block(d.get_X(), None, kernel_options)
+
+
+def dict_weights(d):
+    """Computes the reweighting constants of the samples in a dictionary, s_i = sqrt(q_i / (probs_i * qbar)).
+
+    Parameters
+    ----------
+    d : SampleDict
+        The dictionary.
+
+    Returns
+    -------
+    s : array, shape (q,)
+        The weights.
+    """
+    # q_i can be stored in a small integer type, make sure the square root is computed in double precision
+    s = (np.sqrt(d.q_i, dtype=float) / np.sqrt(d.probs)) / np.sqrt(float(d.qbar))
+
+    # test for numerical errors
+    assert (s > np.finfo(float).eps).all()
+
+    return s
+
+
+def inv_diag(A, solver='cholesky'):
+    """Computes the diagonal of the inverse of a symmetric positive definite matrix, without forming the inverse.
+
+    Parameters
+    ----------
+    A : array, shape (q, q) !!MODIFIED!!
+        The matrix to invert. It is overwritten with intermediate results to avoid additional copies. The 'cholesky'
+        solver only reads its lower triangle.
+    solver : string (optional, default='cholesky')
+        'cholesky' factorizes A = L L^T (LAPACK potrf), inverts the triangular factor (LAPACK trtri) and returns the
+        squared column norms of L^-1, since inv(A) = L^-T L^-1. 'inv' computes the full inverse with an LU
+        factorization, which is roughly three times more expensive but does not require A to be positive definite.
+
+    Returns
+    -------
+    diag : array, shape (q,)
+        The diagonal of inv(A).
+    """
+    # LAPACK only overwrites Fortran-ordered matrices, but since A is symmetric its transpose is a Fortran-ordered view
+    # of the same matrix
+    if A.flags.c_contiguous and not A.flags.f_contiguous:
+        A = A.T
+        # the lower triangle of A is the upper triangle of its transpose
+        lower = False
+    else:
+        lower = True
+
+    if solver == 'cholesky':
+        potrf, trtri = scipy.linalg.get_lapack_funcs(('potrf', 'trtri'), (A,))
+
+        L, info = potrf(A, lower=lower, clean=True, overwrite_a=True)
+        if info > 0:
+            raise np.linalg.LinAlgError(
+                "the {}-th leading minor is not positive definite, try increasing gamma".format(info))
+        assert info == 0
+
+        L_inv, info = trtri(L, lower=lower, overwrite_c=True)
+        assert info == 0
+
+        # with the upper factor A = U^T U, and inv(A) = U^-1 U^-T
+        if lower:
+            return np.einsum('ij,ij->j', L_inv, L_inv)
+        return np.einsum('ij,ij->i', L_inv, L_inv)
+    elif solver == 'inv':
+        return np.diag(scipy.linalg.inv(A, overwrite_a=True))
+    else:
+        raise NotImplementedError
+
+
+def estimate_tau(d_top, kernel_options, solver='cholesky', stats=None):
+    """Given a sample dictionary, estimates the gamma-Ridge Leverage Scores (RLS) tau of all samples in the dictionary
+	to vareps precision.
+
+    Parameters
+    ----------
+    d_top : SampleDict
+        The dictionary whose taus need to be estimated.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+    solver : string (optional, default='cholesky')
+        Method used to compute the diagonal of the inverse, see inv_diag.
+    stats : mapping of string to float (optional, default=None) !!MODIFIED!!
+        If not None, the time spent evaluating the kernel is added to stats['kernel_time'], and the time spent
+        solving for the RLS is stored in stats['solve_time'].
+
+    Returns
+    -------
+    tau : array shape (q,)
+        The estimated RLS.
+    """
+
+    # just aliases for conciseness
+    gamma = d_top.gamma
+    vareps = d_top.vareps
+
+    q = len(d_top.q_i)
+
+    # double check we did not end up dropping all samples because of a too large gamma
+    assert q > 0
+
+    kernel_start = time.perf_counter()
+
+    # compute the dictionary weights
+    s = dict_weights(d_top)
+
+    if d_top.K is not None:
+        # reuse the kernel matrix stored in the dictionary, the multiplication automatically creates a copy so the
+        # stored one is left untouched
+        SKS = s[:, np.newaxis] * d_top.K * s
+    else:
+        # nothing else needs the kernel matrix, so it is scaled in place instead of allocating a copy, and the Cholesky
+        # factorization only reads its lower triangle
+        SKS = kernel_block(d_top.get_X(), None, kernel_options, lower=solver == 'cholesky')
+        SKS *= s[:, np.newaxis]
+        SKS *= s
+
+    assert SKS.shape == (q, q)
+
+    solve_start = time.perf_counter()
+
+    # this avoids creating an additional copy
+    np.fill_diagonal(SKS, SKS.diagonal() + gamma)
+
+    # this is a different reformulation of the estimator reported in the paper
+    # it is strictly equivalent to the one in the paper ONLY for samples in the dictionary, but we only estimate
+    # RLS for samples in the dictionary
+    # on the plus side it is more efficient and simpler
+    # SKS is positive definite since gamma > 0, so by default we only need a Cholesky factorization
+    tau = (1. - 2 * vareps) * np.power(
+        np.sqrt(np.ones(q) - gamma * inv_diag(SKS, solver=solver)) / s, 2)
+
+    if stats is not None:
+        stats['kernel_time'] = stats.get('kernel_time', 0.) + solve_start - kernel_start
+        stats['solve_time'] = time.perf_counter() - solve_start
+
+    return tau
+
+
+def dict_merge_sweep(dicts_left, dicts_right, kernel_options, random_state, merge_options=None):
+    """Merges the dictionaries of a sweep over several regularization parameters (see visit_merge_tree), where each
+    node holds one dictionary per (gamma, vareps). The dictionaries of each gamma are merged as dict_merge would, with a
+    copy of random_state, so every result is the same as the one of a separate run with the same seeds (up to rounding
+    if the eigendecomposition is shared, see estimate_tau_sweep). Instead of once per gamma, the kernel is evaluated
+    once on the union of the samples of all dictionaries, and each gamma takes its own submatrix.
+
+    Parameters
+    ----------
+    dicts_left : list of SampleDict
+        The first dictionary to merge, for each gamma.
+    dicts_right : list of SampleDict
+        The second dictionary to merge, for each gamma.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+    random_state : RandomState
+        RandomState instance used as the random number generator, each gamma uses its own copy.
+    merge_options : mapping of string to any (optional, default=None)
+        Dictionary containing the options of the merge, see dict_merge. 'cache_kernel' is ignored, since the kernel of
+        the union of the samples is evaluated anyway. Additionally:
+        'eigh_min_gammas': The minimum number of gammas sharing the same temporary dictionary for the RLS to be computed
+            with a single eigendecomposition, see estimate_tau_sweep (default 8)
+
+    Returns
+    -------
+    d_tops : list of SampleDict
+        The result of the merge, for each gamma.
+    """
+    if merge_options is None:
+        merge_options = {}
+
+    assert len(dicts_left) == len(dicts_right) > 0
+
+    merge_stats = {'merge_start': time.time(),
+                   'worker': "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)}
+    kernel_start = time.perf_counter()
+
+    d_tops = [concat_dicts([d_left, d_right]) for d_left, d_right in zip(dicts_left, dicts_right)]
+
+    # the dictionaries of different gammas largely overlap, evaluate the kernel only once on the union of the samples
+    all_idx = np.concatenate([d.idx for d in d_tops])
+    union_idx, union_first, union_inverse = np.unique(all_idx, return_index=True, return_inverse=True)
+    if all(d.X is None for d in d_tops):
+        X_union = gather_rows(d_tops[0].source, union_idx)
+    else:
+        X_union = stack_rows([d.get_X() for d in d_tops])[union_first]
+    K_union = kernel_block(X_union, None, kernel_options)
+
+    bounds = np.cumsum([0] + [len(d.q_i) for d in d_tops])
+    for j, d_top in enumerate(d_tops):
+        rows = union_inverse.ravel()[bounds[j]:bounds[j + 1]]
+        d_top.K = K_union[np.ix_(rows, rows)]
+    del K_union
+
+    merge_stats['kernel_time'] = time.perf_counter() - kernel_start
+
+    # estimate RLS
+    taus = estimate_tau_sweep(d_tops,
+                              solver=merge_options.get('tau_solver', 'cholesky'),
+                              eigh_min_gammas=merge_options.get('eigh_min_gammas', 8),
+                              stats=merge_stats)
+
+    rejection_start = time.perf_counter()
+    for d_top, tau in zip(d_tops, taus):
+        merge_random_state = np.random.RandomState()
+        merge_random_state.set_state(random_state.get_state())
+        reject_samples(d_top, tau, merge_random_state)
+
+        # the next merge evaluates the kernel on the union anyway
+        d_top.K = None
+        d_top.merge_stats = merge_stats
+
+    merge_stats['rejection_time'] = time.perf_counter() - rejection_start
+    merge_stats['merge_end'] = time.time()
+
+    return d_tops
+
+
+def estimate_tau_sweep(d_tops, solver='cholesky', eigh_min_gammas=8, stats=None):
+    """Estimates the RLS of several dictionaries that store their kernel matrix, one per (gamma, vareps) of a sweep,
+    see dict_merge_sweep. Dictionaries with the same samples and weights (e.g. at the first merges above the leaves,
+    before the rejection steps of different gammas diverge) only differ in gamma, and if there are at least
+    eigh_min_gammas of them their RLS are computed from a single eigendecomposition SKS = U diag(lambda) U^T, since
+    diag(inv(SKS + gamma I)) = (U * U) 1/(lambda + gamma). An eigendecomposition costs as much as three (for a few
+    hundred samples) to seven (for thousands of samples) Cholesky factorizations and inversions (see inv_diag), so
+    smaller groups are solved separately with estimate_tau.
+
+    Parameters
+    ----------
+    d_tops : list of SampleDict
+        The dictionaries whose taus need to be estimated, with the kernel matrix stored in K.
+    solver : string (optional, default='cholesky')
+        Method used to compute the diagonal of the inverse when solving each dictionary separately, see inv_diag.
+    eigh_min_gammas : int (optional, default=8)
+        The minimum number of dictionaries sharing an eigendecomposition.
+    stats : mapping of string to float (optional, default=None) !!MODIFIED!!
+        If not None, the time spent solving for the RLS is stored in stats['solve_time'].
+
+    Returns
+    -------
+    taus : list of array
+        The estimated RLS of each dictionary.
+    """
+    solve_start = time.perf_counter()
+
+    weights = [dict_weights(d_top) for d_top in d_tops]
+
+    # group the dictionaries whose SKS only differ in the regularization
+    groups = []
+    for j, d_top in enumerate(d_tops):
+        for group in groups:
+            if (np.array_equal(d_tops[group[0]].idx, d_top.idx)
+                    and np.array_equal(weights[group[0]], weights[j])):
+                group.append(j)
+                break
+        else:
+            groups.append([j])
+
+    taus = [None] * len(d_tops)
+    for group in groups:
+        if len(group) < eigh_min_gammas:
+            for j in group:
+                taus[j] = estimate_tau(d_tops[j], None, solver=solver)
+            continue
+
+        s = weights[group[0]]
+        SKS = s[:, np.newaxis] * d_tops[group[0]].K * s
+        eigvals, U = scipy.linalg.eigh(SKS, overwrite_a=True, driver='evd')
+        U *= U
+
+        for j in group:
+            gamma = d_tops[j].gamma
+            vareps = d_tops[j].vareps
+            # see estimate_tau for the estimator
+            taus[j] = (1. - 2 * vareps) * np.power(
+                np.sqrt(np.ones(len(s)) - gamma * U.dot(1. / (eigvals + gamma))) / s, 2)
+
+    if stats is not None:
+        stats['solve_time'] = time.perf_counter() - solve_start
+
+    return taus
+
+
+class MergeTree(object):
+    """A binary tree guiding the dictionary merges, stored as arrays indexed by node. Every node has either two
+    descendants (interior nodes, where merges happen) or none (leaves, holding the samples).
+
+    Attributes
+    ----------
+    children : array, shape (n_nodes, 2)
+        The two descendants of each node, -1 for leaves.
+    parent : array, shape (n_nodes,)
+        The ancestor of each node, -1 for the root.
+    root : int
+        Index of the root node.
+    leaf_assigned_samples : array of objects, shape (n_nodes,)
+        For each leaf, an np.array of indices of the samples in the dataset assigned to the leaf. None for interior
+        nodes.
+    merge_promise : array of objects, shape (n_nodes,)
+        A slot for the MergePromise of each node, filled by visit_merge_tree.
+    """
+
+    def __init__(self, children, leaf_assigned_samples):
+        self.children = np.asarray(children, dtype=np.intp).reshape(-1, 2)
+        n_nodes = self.children.shape[0]
+
+        # double check that the tree is not malformed
+        is_leaf = self.children[:, 0] < 0
+        assert (is_leaf == (self.children[:, 1] < 0)).all()
+        interior = np.nonzero(~is_leaf)[0]
+        assert (np.bincount(self.children[interior].ravel(), minlength=n_nodes) <= 1).all()
+
+        self.parent = np.full(n_nodes, -1, dtype=np.intp)
+        self.parent[self.children[interior, 0]] = interior
+        self.parent[self.children[interior, 1]] = interior
+
+        roots = np.nonzero(self.parent < 0)[0]
+        assert len(roots) == 1
+        self.root = int(roots[0])
+
+        assert len(leaf_assigned_samples) == n_nodes
+        self.leaf_assigned_samples = np.empty(n_nodes, dtype=object)
+        for leaf in np.nonzero(is_leaf)[0]:
+            assert leaf_assigned_samples[leaf] is not None
+            self.leaf_assigned_samples[leaf] = leaf_assigned_samples[leaf]
+
+        self.merge_promise = np.empty(n_nodes, dtype=object)
+
+    @property
+    def n_nodes(self):
+        return self.children.shape[0]
+
+    def is_leaf(self, node):
+        return self.children[node, 0] < 0
+
+    def leaves(self):
+        """Returns the indices of all leaves, in increasing order."""
+        return np.nonzero(self.children[:, 0] < 0)[0]
+
+    def postorder(self, node=None):
+        """Returns the nodes of the subtree rooted in node (by default the whole tree), ordered so that descendants come
+        before their ancestor."""
+        order = []
+        stack = [self.root if node is None else node]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if not self.is_leaf(node):
+                stack.extend(self.children[node].tolist())
+        # in a preorder ancestors come before descendants
+        return order[::-1]
+
+    def subtree_samples(self):
+        """Returns the number of samples assigned to the leaves below each node."""
+        n_samples = np.zeros(self.n_nodes, dtype=np.intp)
+        for node in self.postorder():
+            if self.is_leaf(node):
+                n_samples[node] = len(self.leaf_assigned_samples[node])
+            else:
+                n_samples[node] = n_samples[self.children[node]].sum()
+        return n_samples
+
+    def depths(self):
+        """Returns the depth of each node, i.e. the number of merges between the node and the root."""
+        depth = np.zeros(self.n_nodes, dtype=np.intp)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not self.is_leaf(node):
+                depth[self.children[node]] = depth[node] + 1
+                stack.extend(self.children[node].tolist())
+        return depth
+
+    @classmethod
+    def sequential(cls, chunks):
+        """Builds a completely unbalanced (sequential) tree with one leaf per chunk. Nodes 0, ..., k - 1 form a chain
+        rooted in 0 whose end holds the last chunk, and the i-th chunk is held by leaf k + i, attached to the i-th node
+        of the chain.
+
+        Parameters
+        ----------
+        chunks : list of array
+            The indices of the samples assigned to each leaf.
+
+        Returns
+        -------
+        merge_tree : MergeTree
+            The tree.
+        """
+        k = len(chunks)
+        n_nodes = 2 * k - 1
+
+        children = np.full((n_nodes, 2), -1, dtype=np.intp)
+        chain = np.arange(k - 1)
+        children[chain, 0] = chain + 1
+        children[chain, 1] = chain + k
+
+        leaf_assigned_samples = [None] * n_nodes
+        leaf_assigned_samples[k - 1] = chunks[k - 1]
+        leaf_assigned_samples[k:] = chunks[:k - 1]
+
+        return cls(children, leaf_assigned_samples)
+
+    @classmethod
+    def balanced(cls, chunks):
+        """Builds a balanced (fully parallel) tree with one leaf per chunk. The tree is a complete binary tree of depth
+        h = floor(log2(k)), where node i has descendants 2i + 1 and 2i + 2, and where the first k - 2**h leaves are
+        split in two additional leaves, so that the minimum and maximum path from the root differ by at most one.
+
+        Parameters
+        ----------
+        chunks : list of array
+            The indices of the samples assigned to each leaf.
+
+        Returns
+        -------
+        merge_tree : MergeTree
+            The tree.
+        """
+        k = len(chunks)
+        h = int(np.floor(np.log2(k)))
+        diff = k - 2 ** h
+
+        n_complete = 2 ** (h + 1) - 1
+        n_nodes = n_complete + 2 * diff
+
+        children = np.full((n_nodes, 2), -1, dtype=np.intp)
+        interior = np.arange(2 ** h - 1)
+        children[interior, 0] = 2 * interior + 1
+        children[interior, 1] = 2 * interior + 2
+
+        # the leaves of the complete tree that need to be split in two, and their new descendants
+        split = np.arange(2 ** h - 1, 2 ** h - 1 + diff)
+        children[split, 0] = n_complete + 2 * np.arange(diff)
+        children[split, 1] = n_complete + 2 * np.arange(diff) + 1
+
+        # the new leaves get the first 2 * diff chunks, the remaining leaves of the complete tree the others
+        leaf_assigned_samples = [None] * n_nodes
+        leaf_assigned_samples[n_complete:] = chunks[:2 * diff]
+        leaf_assigned_samples[2 ** h - 1 + diff:n_complete] = chunks[2 * diff:]
+
+        return cls(children, leaf_assigned_samples)
+
+    @classmethod
+    def from_networkx(cls, graph, root):
+        """Converts a tree stored as a networkx.DiGraph, whose leaves have a 'leaf_assigned_samples' field. Nodes are
+        renumbered in the order they are stored in the graph.
+
+        Parameters
+        ----------
+        graph : networkx.DiGraph
+            The tree, with edges going from ancestors to descendants.
+        root : any
+            The root node.
+
+        Returns
+        -------
+        merge_tree : MergeTree
+            The tree.
+        """
+        nodes = list(graph.nodes())
+        position = {node: i for i, node in enumerate(nodes)}
+        # networkx 1.x stores node attributes in graph.node, later versions in graph.nodes
+        node_attrs = graph.node if hasattr(graph, 'node') else graph.nodes
+
+        children = np.full((len(nodes), 2), -1, dtype=np.intp)
+        leaf_assigned_samples = [None] * len(nodes)
+        for node in nodes:
+            successors = list(graph.successors(node))
+            assert len(successors) == 2 or len(successors) == 0
+
+            if successors:
+                children[position[node]] = [position[successor] for successor in successors]
+            else:
+                leaf_assigned_samples[position[node]] = node_attrs[node]['leaf_assigned_samples']
+
+        merge_tree = cls(children, leaf_assigned_samples)
+        assert merge_tree.root == position[root]
+
+        return merge_tree
+
+
+class MergeMetrics(object):
+    """Collects structured statistics about each merge, to be passed to visit_merge_tree or visit_dynamic_merges
+    through exp_options['merge_metrics']. For each merge a record is stored with the fields:
+    'merge': identifier of the merge (the node for visit_merge_tree, a counter for visit_dynamic_merges)
+    'dispatch_time', 'merge_start', 'merge_end', 'completion_time': wall clock times (time.time()) when the merge was
+        sent to the rpc_invoker, started and ended on the worker, and was seen as completed by the scheduler
+    'queue_wait': seconds between the dispatch and the start of the merge. Only meaningful if the clocks of the
+        workers and the scheduler are synchronized
+    'kernel_time', 'solve_time', 'rejection_time': seconds spent by the merge evaluating the kernel, solving for the
+        RLS (see estimate_tau) and performing the rejection step
+    'input_sizes', 'output_size': the number of samples in the merged dictionaries and in the result (the total over
+        all gammas for the merges of a sweep)
+    'input_bytes', 'output_bytes': the size of the arrays sent to and received from the worker, see dict_nbytes
+    'worker': hostname, process id and thread name of the worker that executed the merge
+    'fused_merges': the number of merges executed by the task, more than 1 for a fused subtree (see merge_subtree),
+        whose record describes all its merges together
+
+    Parameters
+    ----------
+    hooks : list of callable (optional, default=())
+        Functions called with each record, as soon as the merge is completed.
+
+    Attributes
+    ----------
+    records : list of mapping of string to any
+        The records of all completed merges, in order of completion.
+    """
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.records = []
+        self._dispatched = {}
+
+    def add_hook(self, hook):
+        """Registers a function called with each record, as soon as the merge is completed.
+
+        Parameters
+        ----------
+        hook : callable
+            The function.
+        """
+        self.hooks.append(hook)
+
+    def merge_dispatched(self, merge, input_dicts):
+        """Records that a merge was sent to the rpc_invoker.
+
+        Parameters
+        ----------
+        merge : int
+            Identifier of the merge.
+        input_dicts : list of SampleDict
+            The dictionaries being merged.
+        """
+        self._dispatched[merge] = (time.time(), [len(d.q_i) for d in input_dicts],
+                                   sum(dict_nbytes(d) for d in input_dicts))
+
+    def merge_completed(self, merge, d_top):
+        """Records that a merge is completed, and invokes the hooks with its record.
+
+        Parameters
+        ----------
+        merge : int
+            Identifier of the merge.
+        d_top : SampleDict or list of SampleDict
+            The result of the merge, a list for the merges of a sweep (see dict_merge_sweep).
+        """
+        dispatch_time, input_sizes, input_bytes = self._dispatched.pop(merge)
+        d_tops = d_top if isinstance(d_top, list) else [d_top]
+        stats = d_tops[0].merge_stats if d_tops[0].merge_stats is not None else {}
+
+        record = {'merge': int(merge),
+                  'dispatch_time': dispatch_time,
+                  'merge_start': stats.get('merge_start'),
+                  'merge_end': stats.get('merge_end'),
+                  'completion_time': time.time(),
+                  'queue_wait': stats['merge_start'] - dispatch_time if 'merge_start' in stats else None,
+                  'kernel_time': stats.get('kernel_time'),
+                  'solve_time': stats.get('solve_time'),
+                  'rejection_time': stats.get('rejection_time'),
+                  'input_sizes': input_sizes,
+                  'output_size': sum(len(d.q_i) for d in d_tops),
+                  'input_bytes': input_bytes,
+                  'output_bytes': sum(dict_nbytes(d) for d in d_tops),
+                  'worker': stats.get('worker'),
+                  'fused_merges': stats.get('fused_merges', 1)}
+
+        self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def to_jsonl(self, path):
+        """Writes the records as JSON lines, one record per line.
+
+        Parameters
+        ----------
+        path : string
+            Path of the output file.
+        """
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+    def to_chrome_trace(self, path):
+        """Writes the records in the Chrome trace event format, which can be opened in chrome://tracing or Perfetto.
+        Each worker is shown as a separate thread, with one event per merge split in its kernel, solve and rejection
+        phases, and the scheduler thread shows the time each merge spent waiting to start.
+
+        Parameters
+        ----------
+        path : string
+            Path of the output file.
+        """
+        events = []
+        for record in self.records:
+            if record['merge_start'] is None:
+                continue
+
+            # trace timestamps and durations are in microseconds
+            merge_start = record['merge_start'] * 1e6
+            args = {key: record[key] for key in ('input_sizes', 'output_size', 'input_bytes', 'output_bytes')}
+
+            events.append({'name': "merge {}".format(record['merge']), 'ph': 'X', 'pid': 'workers',
+                           'tid': record['worker'], 'ts': merge_start,
+                           'dur': (record['merge_end'] - record['merge_start']) * 1e6, 'args': args})
+
+            phase_start = merge_start
+            for phase in ('kernel', 'solve', 'rejection'):
+                duration = record[phase + '_time'] * 1e6
+                events.append({'name': phase, 'ph': 'X', 'pid': 'workers', 'tid': record['worker'],
+                               'ts': phase_start, 'dur': duration})
+                phase_start = phase_start + duration
+
+            events.append({'name': "wait {}".format(record['merge']), 'ph': 'X', 'pid': 'scheduler',
+                           'tid': 'queue', 'ts': record['dispatch_time'] * 1e6,
+                           'dur': max(0., record['queue_wait']) * 1e6})
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class MergeCheckpoint(object):
+    """Stores the dictionaries of the completed merges of a MergeTree in a local directory, so that a visit interrupted
+    by a failure of the driver can be resumed without recomputing them (see visit_merge_tree).
+
+    The directory contains a 'manifest.json' file describing the merge tree and the seeds of its merges (see
+    draw_merge_seeds), and one 'node_<i>.npz' file per completed merge with the arrays of its SampleDict and its seed.
+    Each file is written to a temporary file and then renamed, so a file is either complete or missing even if the
+    driver dies while writing it. A checkpoint can only be resumed with the same merge tree and seeds, i.e. the same
+    input, exp_options and random_state: merges recomputed after a restart then use the same seeds as in the original
+    run, and the resumed visit returns the same dictionary as an uninterrupted one. The manifest also records the
+    options that determine the stored dictionaries (see CHECKPOINT_OPTIONS), and resuming with different ones raises a
+    ValueError. Functions in the options (e.g. a callable kernel) are compared by their qualified name, and other
+    objects that cannot be stored in json only by their type.
+
+    Parameters
+    ----------
+    directory : string
+        Path of the checkpoint directory, created if it does not exist.
+    merge_tree : MergeTree
+        The merge tree being visited.
+    seeds : np.array, shape (merge_tree.n_nodes,)
+        The seed of the merge of each node.
+    exp_options : mapping of string to any
+        Dictionary containing the experiment options of the visit.
+    """
+
+    # the experiment options that change the dictionaries computed by the merges
+    CHECKPOINT_OPTIONS = ('qbar', 'gamma', 'vareps', 'kernel_options', 'merge_options')
+
+    def __init__(self, directory, merge_tree, seeds, exp_options):
+        self.directory = directory
+        self.seeds = seeds
+
+        # the fingerprint identifies the merge tree, including the samples assigned to each leaf, and the seeds
+        fingerprint = hashlib.sha256()
+        fingerprint.update(np.ascontiguousarray(merge_tree.children, dtype=np.int64).tobytes())
+        fingerprint.update(np.ascontiguousarray(seeds, dtype=np.int64).tobytes())
+        for node in merge_tree.leaves():
+            fingerprint.update(np.ascontiguousarray(merge_tree.leaf_assigned_samples[node], dtype=np.int64).tobytes())
+
+        # a round trip through json normalizes the options (tuples, numpy scalars) as they are stored in the manifest,
+        # a sequence of gammas or vareps (a sweep) stays distinct from a single value
+        options = {key: exp_options.get(key, {} if key == 'merge_options' else None)
+                   for key in self.CHECKPOINT_OPTIONS}
+        options['sweep'] = np.ndim(exp_options['gamma']) > 0 or np.ndim(exp_options['vareps']) > 0
+        options = json.loads(json.dumps(options, sort_keys=True, default=self._json_default))
+
+        manifest = {'n_nodes': merge_tree.n_nodes,
+                    'root': int(merge_tree.root),
+                    'fingerprint': fingerprint.hexdigest(),
+                    'options': options,
+                    'seeds': seeds.tolist()}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        manifest_path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                stored_manifest = json.load(f)
+            if stored_manifest['fingerprint'] != manifest['fingerprint']:
+                raise ValueError("the checkpoint in {} was written for a different merge tree or random_state"
+                                 .format(directory))
+            stored_options = stored_manifest.get('options', {})
+            changed = sorted(key for key in options if stored_options.get(key) != options[key])
+            if changed:
+                raise ValueError("the checkpoint in {} was written with different exp_options: {}".format(
+                    directory, ", ".join("{}={} instead of {}".format(key, options[key], stored_options.get(key))
+                                         for key in changed)))
+        else:
+            self._write(manifest_path, lambda f: f.write(json.dumps(manifest).encode()))
+
+    @staticmethod
+    def _json_default(value):
+        # numpy values are stored as their python equivalent
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+
+        # the repr of functions and other objects contains their memory address, which changes in every process.
+        # Functions are identified by their name, other objects only by their type
+        if hasattr(value, '__module__') and hasattr(value, '__qualname__'):
+            return "{}.{}".format(value.__module__, value.__qualname__)
+        warnings.warn("the checkpoint cannot check that the {} in the options is the same when resuming, only its type"
+                      .format(type(value).__name__))
+        return "<{}.{} object>".format(type(value).__module__, type(value).__qualname__)
+
+    def _node_path(self, node):
+        return os.path.join(self.directory, 'node_{}.npz'.format(node))
+
+    @staticmethod
+    def _write(path, write_fn):
+        # write to a temporary file first, so that an interrupted write never leaves a partial file behind
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def completed(self):
+        """Lists the nodes whose dictionary is stored in the checkpoint.
+
+        Returns
+        -------
+        nodes : list of int
+            The completed nodes, in increasing order.
+        """
+        nodes = []
+        for name in os.listdir(self.directory):
+            if name.startswith('node_') and name.endswith('.npz'):
+                nodes.append(int(name[len('node_'):-len('.npz')]))
+        return sorted(nodes)
+
+    def save(self, node, d):
+        """Stores the dictionary of a completed merge.
+
+        Parameters
+        ----------
+        node : int
+            The node of the merge.
+        d : SampleDict or list of SampleDict
+            The dictionary returned by the merge, a list for the merges of a sweep (see dict_merge_sweep).
+        """
+        dicts = d if isinstance(d, list) else [d]
+        arrays = {'seed': self.seeds[node], 'sweep': isinstance(d, list), 'n_dicts': len(dicts)}
+        for j, d_j in enumerate(dicts):
+            prefix = 'd{}_'.format(j)
+            for key in ('probs', 'q_i', 'qbar', 'gamma', 'vareps'):
+                arrays[prefix + key] = getattr(d_j, key)
+            # in index mode the samples are not stored, they are gathered again from the input when resuming
+            for key in ('idx', 'K'):
+                if getattr(d_j, key) is not None:
+                    arrays[prefix + key] = getattr(d_j, key)
+            if scipy.sparse.issparse(d_j.X):
+                X_csr = d_j.X.tocsr()
+                for key in ('data', 'indices', 'indptr', 'shape'):
+                    arrays[prefix + 'X_' + key] = getattr(X_csr, key)
+            elif d_j.X is not None:
+                arrays[prefix + 'X'] = d_j.X
+
+        self._write(self._node_path(node), lambda f: np.savez(f, **arrays))
+
+    def load(self, node, source):
+        """Loads the dictionary of a completed merge.
+
+        Parameters
+        ----------
+        node : int
+            The node of the merge.
+        source : array-like, shape (n, n_features)
+            The input samples, used as source of the dictionaries stored in index mode.
+
+        Returns
+        -------
+        d : SampleDict or list of SampleDict
+            The dictionary returned by the merge.
+        """
+        with np.load(self._node_path(node), allow_pickle=False) as arrays:
+            assert arrays['seed'] == self.seeds[node]
+
+            dicts = []
+            for j in range(int(arrays['n_dicts'])):
+                prefix = 'd{}_'.format(j)
+                X = arrays[prefix + 'X'] if prefix + 'X' in arrays else None
+                if prefix + 'X_data' in arrays:
+                    X = scipy.sparse.csr_matrix((arrays[prefix + 'X_data'], arrays[prefix + 'X_indices'],
+                                                 arrays[prefix + 'X_indptr']), shape=tuple(arrays[prefix + 'X_shape']))
+                dicts.append(SampleDict(X=X,
+                                        probs=arrays[prefix + 'probs'],
+                                        q_i=arrays[prefix + 'q_i'],
+                                        qbar=arrays[prefix + 'qbar'].item(),
+                                        gamma=arrays[prefix + 'gamma'].item(),
+                                        vareps=arrays[prefix + 'vareps'].item(),
+                                        K=arrays[prefix + 'K'] if prefix + 'K' in arrays else None,
+                                        idx=arrays[prefix + 'idx'] if prefix + 'idx' in arrays else None,
+                                        source=source if X is None else None))
+
+            return dicts if arrays['sweep'] else dicts[0]
+
+
+def merge_flops(q, n_features, n_dicts=1):
+    """Estimates the number of floating point operations of a merge: the evaluation of the kernel (2 q^2 n_features)
+    and the Cholesky factorization and inversion of each dictionary (about q^3, see inv_diag).
+
+    Parameters
+    ----------
+    q : int
+        The number of samples in the merge.
+    n_features : float
+        The number of features of the samples, or the average number of non-zero features for sparse samples.
+    n_dicts : int (optional, default=1)
+        The number of dictionaries merged together, for the merges of a sweep (see dict_merge_sweep).
+
+    Returns
+    -------
+    flops : float
+        The estimated number of operations.
+    """
+    return 2. * q ** 2 * n_features + n_dicts * float(q) ** 3
+
 
-    q = d_top.q_i.shape[0]
+def fused_subtrees(merge_tree, n_features, max_merge_size, max_flops, excluded=(), n_dicts=1):
+    """Selects the subtrees of a merge tree whose merges are cheap enough to be performed in a single task, see
+    merge_subtree. The cost of a merge is estimated with merge_flops, assuming it contains all the samples assigned to
+    the leaves below it, up to max_merge_size. The selected subtrees are the largest ones whose total cost does not
+    exceed max_flops, and that contain at least two merges.
 
-    assert d_top.X.shape == (q, d_left.X.shape[1])
-    assert d_top.q_i.shape == (q,)  # well, duh
-    assert d_top.probs.shape == (q,)
+    Parameters
+    ----------
+    merge_tree : MergeTree
+        The merge tree.
+    n_features : float
+        The number of features of the samples, see merge_flops.
+    max_merge_size : int
+        The maximum number of samples in a merge.
+    max_flops : float
+        The maximum estimated cost of a fused subtree.
+    excluded : set of int (optional, default=())
+        Nodes that cannot be part of a fused subtree (e.g. restored from a checkpoint), nothing below them is selected.
+    n_dicts : int (optional, default=1)
+        The number of dictionaries in each node, see merge_flops.
 
-    assert (d_top.q_i != 0).all()
+    Returns
+    -------
+    fused : set of int
+        The roots of the fused subtrees.
+    """
+    children = merge_tree.children
+    n_samples = merge_tree.subtree_samples()
+
+    # accumulate the cost and number of merges of each subtree, and whether it contains any excluded node
+    flops = np.zeros(merge_tree.n_nodes)
+    n_merges = np.zeros(merge_tree.n_nodes, dtype=np.intp)
+    blocked = np.zeros(merge_tree.n_nodes, dtype=bool)
+    for node in merge_tree.postorder():
+        blocked[node] = node in excluded
+        if merge_tree.is_leaf(node):
+            continue
+
+        left, right = children[node].tolist()
+        flops[node] = flops[left] + flops[right] + merge_flops(min(n_samples[node], max_merge_size), n_features,
+                                                               n_dicts=n_dicts)
+        n_merges[node] = n_merges[left] + n_merges[right] + 1
+        blocked[node] = blocked[node] or blocked[left] or blocked[right]
+
+    # select the subtrees closest to the root
+    fused = set()
+    stack = [merge_tree.root]
+    while stack:
+        node = stack.pop()
+        if merge_tree.is_leaf(node) or node in excluded:
+            continue
+        if not blocked[node] and flops[node] <= max_flops and n_merges[node] >= 2:
+            fused.add(node)
+        else:
+            stack.extend(children[node].tolist())
 
-    return d_top
+    return fused
 
 
-def estimate_tau(d_top, kernel_options):
-    """Given a sample dictionary, estimates the gamma-Ridge Leverage Scores (RLS) tau of all samples in the dictionary
-	to vareps precision.
+def merge_subtree(merge_function, children, inputs, seeds, kernel_options, merge_options=None, max_merge_size=None):
+    """Performs all the merges of a subtree of a merge tree in the current process, and returns the dictionary of its
+    root. This is the function executed by the rpc_invoker for the fused subtrees of visit_merge_tree, so that a
+    subtree of small merges costs a single round trip. Each merge uses the seed of its node, so the result is the same
+    as if the merges were executed separately.
 
     Parameters
     ----------
-    d_top : SampleDict
-        The dictionary whose taus need to be estimated.
+    merge_function : callable
+        The function merging two dictionaries, dict_merge or dict_merge_sweep.
+    children : array, shape (n_nodes, 2)
+        The two descendants of each node of the subtree, -1 for leaves. Nodes are ordered so that descendants come
+        before their ancestor, the last node being the root of the subtree.
+    inputs : list
+        The dictionary of each leaf (a list of dictionaries for a sweep), None for interior nodes.
+    seeds : array, shape (n_nodes,)
+        The seed of the merge of each node, see draw_merge_seeds.
     kernel_options : mapping of string to any
         Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+    merge_options : mapping of string to any (optional, default=None)
+        Dictionary containing the options of the merge, see dict_merge.
+    max_merge_size : int (optional, default=None)
+        If not None, the maximum number of samples in the input of each merge.
 
     Returns
     -------
-    tau : array shape (q,)
-        The estimated RLS.
+    d_top : SampleDict or list of SampleDict
+        The dictionary of the root of the subtree. Its merge_stats describe all the merges of the subtree together.
     """
+    results = list(inputs)
+    merge_stats = []
+
+    for node in range(len(children)):
+        if children[node, 0] < 0:
+            continue
+
+        left, right = children[node].tolist()
+        d_left = results[left]
+        d_right = results[right]
+        # release the descendants, only the ancestor needs them
+        results[left] = results[right] = None
+
+        if max_merge_size is not None:
+            # in a sweep the dictionaries of each gamma are merged separately
+            pairs = zip(d_left, d_right) if isinstance(d_left, list) else [(d_left, d_right)]
+            assert all(len(l_dict.q_i) + len(r_dict.q_i) <= max_merge_size for l_dict, r_dict in pairs)
+
+        results[node] = merge_function(d_left, d_right, kernel_options, np.random.RandomState(seeds[node]),
+                                       merge_options)
+        merge_stats.append((results[node][0] if isinstance(results[node], list) else results[node]).merge_stats)
+
+    d_top = results[-1]
+
+    # report the merges of the subtree as a single one, see MergeMetrics
+    fused_stats = {'merge_start': merge_stats[0]['merge_start'],
+                   'merge_end': merge_stats[-1]['merge_end'],
+                   'worker': merge_stats[-1]['worker'],
+                   'fused_merges': len(merge_stats)}
+    for key in ('kernel_time', 'solve_time', 'rejection_time'):
+        fused_stats[key] = sum(stats.get(key, 0.) for stats in merge_stats)
+    for d in (d_top if isinstance(d_top, list) else [d_top]):
+        d.merge_stats = fused_stats
 
-    # just aliases for conciseness
-    gamma = d_top.gamma
-    vareps = d_top.vareps
-    qbar = d_top.qbar
-
-    q = len(d_top.q_i)
-
-    # double check we did not end up dropping all samples because of a too large gamma
-    assert q > 0
-
-    # construct kernel matrix between samples in the dictionary
-    K = pairwise_kernels(d_top.X, **kernel_options, filter_params=True)
-
-    assert K.shape == (q, q)
+    return d_top
 
-    # compute the dictionary weights
-    s = (np.sqrt(d_top.q_i) / np.sqrt(d_top.probs)) / np.sqrt(float(qbar))
 
-    # test for numerical errors
-    assert (s > np.finfo(float).eps).all()
+def share_input(X, rpc_invoker, exp_options):
+    """Decides whether the dictionaries should be created in index mode, and if so makes the input samples available
+    to the workers of the rpc_invoker. Invokers that can share the input with their workers (see get_rpc_invoker)
+    default to index mode, where dictionaries only transfer indices of the shared input, unless they cannot share this
+    particular input (e.g. a HDF5 dataset with the 'processes' backend), in which case the samples are gathered in the
+    dictionaries. Requesting index mode for such an input raises a ValueError.
 
-    # the multiplication automatically creates a copy
-    # TODO: could delete K here to free up some memory
-    SKS = s[:, np.newaxis] * K * s
+    Parameters
+    ----------
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input.
+    rpc_invoker : callable
+        The invoker that will execute the merges.
+    exp_options : mapping of string to any
+        Dictionary containing the experiment options, see visit_merge_tree.
 
-    # this avoids creating an additional copy
-    np.fill_diagonal(SKS, SKS.diagonal() + gamma)
+    Returns
+    -------
+    X : array-like, shape (n, n_features)
+        The input samples, possibly wrapped to be shared with the workers.
+    index_dicts : bool
+        Whether the dictionaries should be created in index mode.
+    """
+    index_dicts = exp_options.get('index_dicts')
+    if not hasattr(rpc_invoker, 'share_input') or index_dicts is False:
+        return X, bool(index_dicts)
 
-    # this is a different reformulation of the estimator reported in the paper
-    # it is strictly equivalent to the one in the paper ONLY for samples in the dictionary, but we only estimate
-    # RLS for samples in the dictionary
-    # on the plus side it is more efficient and simpler
-    # TODO: check if the inv is the most efficient and numerically stable choice, replace with e.g. pinv(), svd() or solve()
-    tau = (1. - 2 * vareps) * np.power(
-        np.sqrt(np.ones(q) - gamma * np.diag(scipy.linalg.inv(SKS, overwrite_a=True))) / s, 2)
+    shared_X = rpc_invoker.share_input(X)
+    if shared_X is None:
+        if index_dicts:
+            raise ValueError("index_dicts requires sharing the input with the workers, which is not supported for {}"
+                             .format(type(X).__name__))
+        return X, False
 
-    return tau
+    return shared_X, True
 
 
 def visit_merge_tree(X, merge_tree, root, rpc_invoker, exp_options, random_state):
     """Visits the merge tree, computing the necessary merges. All squeak variants simply feed a different tree to this
-    routine. Leaves in the input tree must possess a 'leaf_assigned_sample' field containing an np.array of indices,
+    routine. Leaves in the input tree must possess a 'leaf_assigned_samples' field containing an np.array of indices,
     indicating which samples in the dataset are assigned to that leaf. For all interior nodes, visit_merge_tree will:
     (1) collect the dictionaries contained in the two descendant
     (2) invoke the dict_merge function on the two dictionaries ,using the rpc_invoker to execute it asynchronously
@@ -265,6 +2461,14 @@ def visit_merge_tree(X, merge_tree, root, rpc_invoker, exp_options, random_state
     The computation proceeds from the leaves to the root. Once it completes, the 'merge_promise' field
     in the root contains a dictionary (again wrapped in a Mergepromise) that well approximates the whole dataset.
 
+    To bound the memory used by the visit, the samples of a leaf are only gathered from X when the merge of its
+    ancestor is scheduled, and the 'merge_promise' of an interior node is removed once its ancestor has collected it.
+
+    The merges are scheduled as soon as they become ready: every node keeps a counter of its unfinished descendants,
+    and when a merge completes the counter of its ancestor is decremented, pushing it in a ready queue once it reaches
+    zero. Promises that expose an add_done_callback(fn) method notify their completion directly, all others are
+    polled (only among the running merges) every 'poll_interval' seconds.
+
     Required fields in exp_options to run the algorithm are:
     'qbar': The number of copies used to initialize the sequential Binomial sampling process and for reweighting
     'gamma': The regularization parameter used to compute the Ridge Leverage Scores.
@@ -274,14 +2478,50 @@ def visit_merge_tree(X, merge_tree, root, rpc_invoker, exp_options, random_state
     'kernel_options': Dictionary containing the kernel function used as a similarity, with all associated
         parameters (keyword arguments)
 
+    If 'gamma' or 'vareps' is a sequence (the other one being broadcast to it), a single visit computes a dictionary
+    for each (gamma, vareps): every node holds a list of dictionaries, merged together by dict_merge_sweep to share the
+    kernel evaluations, and the returned MergePromise contains the list of the dictionaries at the root. Each of them
+    is the same as the one of a separate visit with that gamma and the same random_state, up to rounding.
+
+    Optional fields in exp_options are:
+    'poll_interval': Seconds to wait between two checks of promises that do not support completion callbacks
+        (default 0.5)
+    'merge_options': Dictionary containing the options passed to each dict_merge, see dict_merge (default {})
+    'index_dicts': Whether the dictionaries only store the indices of their samples in X instead of a copy, see
+        SampleDict (default True if the rpc_invoker can share X with its workers, see get_rpc_invoker, else False)
+    'merge_metrics': A MergeMetrics instance collecting statistics about each merge (default None)
+    'checkpoint_dir': Path of a directory where the dictionary of each completed merge is stored, see MergeCheckpoint.
+        If the directory already contains a checkpoint of the same visit, the stored merges are not recomputed, and
+        neither are the merges below them (default None)
+    'straggler_factor': If set, a merge that has been running for more than straggler_factor times the median duration
+        of the completed merges at the same depth of the tree is considered a straggler, and a copy of it is launched.
+        Both copies use the same seed and produce the same dictionary, whichever finishes first is used and the other
+        is cancelled if the promise supports it. Merges at the top of the tree, with too few completed merges at their
+        depth, are compared with the closest depth below them, since all merges have a bounded size. The time spent
+        in a queue is not counted: a merge is running from when it is first seen started by a worker (see
+        promise_started, checked every 'poll_interval' seconds), and the durations of the completed merges are the
+        ones measured by the workers (see MergeMetrics) (default None, no copies are launched)
+    'straggler_min_merges': The number of completed merges at a depth needed to estimate their median duration
+        (default 3)
+    'fusion_max_flops': If set, the largest subtrees whose merges are estimated to cost at most fusion_max_flops
+        floating point operations (see fused_subtrees) are executed by a single task, see merge_subtree. This saves
+        the round trips of many small merges at the bottom of the tree, e.g. with a small max_dict_size. A fused
+        subtree is reported as a single merge to merge_metrics and checkpointed as a single node, and no straggler
+        copy is launched for it. As a rule of thumb, a core performs 1e9 to 1e10 operations per second
+        (default None, no subtree is fused)
+
+    The seed of each merge is drawn in advance from random_state (see draw_merge_seeds), so for a fixed random_state
+    the result does not depend on the order in which the merges complete, nor on whether the visit was resumed.
+
     Parameters
     ----------
-    X : array, shape (q, n_features)
-        Input samples.
-    merge_tree : networkx.DiGraph !!MODIFIED!!
-        The binary tree guiding the dictionary merges.
-    root : int
-        Index of the root node.
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input.
+    merge_tree : MergeTree or networkx.DiGraph !!MODIFIED!!
+        The binary tree guiding the dictionary merges. A networkx.DiGraph is converted to a MergeTree (see
+        MergeTree.from_networkx), and only the 'merge_promise' field of its root is set.
+    root : int or None
+        Index of the root node. Can be None for a MergeTree.
     rpc_invoker : callable
         An invoker that satisfies the signature rpc_invoker(dict_merge , [merge args]) -> MergePromise.
     exp_options : mapping of string to any
@@ -294,120 +2534,474 @@ def visit_merge_tree(X, merge_tree, root, rpc_invoker, exp_options, random_state
     MergePromise containing a dictionary that well approximates the whole dataset.
     """
 
-    leaves = [leaf for leaf in merge_tree.nodes_iter() if merge_tree.out_degree(leaf) == 0]
+    if not isinstance(merge_tree, MergeTree):
+        graph = merge_tree
+        merge_tree = MergeTree.from_networkx(graph, root)
+
+        root_dict_promise = visit_merge_tree(X, merge_tree, None, rpc_invoker, exp_options, random_state)
+        (graph.node if hasattr(graph, 'node') else graph.nodes)[root]['merge_promise'] = root_dict_promise
+
+        return root_dict_promise
+
+    if root is None:
+        root = merge_tree.root
+    assert root == merge_tree.root
+
+    # just aliases for conciseness
+    children = merge_tree.children
+    parent = merge_tree.parent
+
+    leaves = merge_tree.leaves()
+
+    # the kernel cost grows with the number of non-zero features of sparse inputs, see fused_subtrees
+    n_features = X.nnz / max(X.shape[0], 1) if scipy.sparse.issparse(X) else X.shape[1]
+
+    X, index_dicts = share_input(X, rpc_invoker, exp_options)
 
-    # for each leaf, wrap the assigned samples into a completed MergePromise, with a dictionary containing all samples
-    # with multiplicity qbar and probability 1. These initialization dictionaries are guaranteed to be accurate
-    # since they simply store all samples.
-    for leaf in leaves:
-        n_i = merge_tree.node[leaf]['leaf_assigned_samples'].shape[0]
-        merge_tree.node[leaf]['merge_promise'] = MergePromise(is_finished=True,
-                                                              result=SampleDict(
-                                                                  X=X[merge_tree.node[leaf]['leaf_assigned_samples'],
-                                                                    :], probs=np.ones(n_i),
-                                                                  q_i=np.ones(n_i, dtype=int) * (
-                                                                      int(np.round(exp_options['qbar']))),
-                                                                  qbar=int(np.round(exp_options['qbar'])),
-                                                                  gamma=float(exp_options['gamma']),
-                                                                  vareps=float(exp_options['vareps'])))
+    # in a sweep every node holds a list of dictionaries, one per (gamma, vareps)
+    sweep = np.ndim(exp_options['gamma']) > 0 or np.ndim(exp_options['vareps']) > 0
+    if sweep:
+        sweep_options = [dict(exp_options, gamma=gamma, vareps=vareps)
+                         for gamma, vareps in zip(*np.broadcast_arrays(exp_options['gamma'], exp_options['vareps']))]
+        merge_function = dict_merge_sweep
+    else:
+        merge_function = dict_merge
+
+    def collect_dict(node):
+        # leaves are loaded only when needed, see leaf_dict
+        if merge_tree.is_leaf(node):
+            if sweep:
+                return [leaf_dict(X, merge_tree.leaf_assigned_samples[node], options, index_dicts=index_dicts)
+                        for options in sweep_options]
+            return leaf_dict(X, merge_tree.leaf_assigned_samples[node], exp_options, index_dicts=index_dicts)
+
+        # unwrap the result, and release it since only the ancestor needs it
+        merge_promise = merge_tree.merge_promise[node]
+        merge_tree.merge_promise[node] = None
+        return merge_promise.result
+
+    def fetch_result(node):
+        # remote promises (e.g. dask futures) fetch their result again on each access, so it is fetched once and the
+        # promise replaced by a local one, read by the metrics, the checkpoint and the ancestor
+        merge_promise = merge_tree.merge_promise[node]
+        if not isinstance(merge_promise, MergePromise):
+            merge_promise = MergePromise(is_finished=True, result=merge_promise.result)
+            merge_tree.merge_promise[node] = merge_promise
+        return merge_promise.result
+
+    # each merge gets its own reproducible rng, see draw_merge_seeds
+    seeds = draw_merge_seeds(random_state, merge_tree.n_nodes)
 
     # total number of merges we need to do is the number of interior nodes, which is number of leaves - 1 since this
     # is a binary tree
     merge_total = len(leaves) - 1
 
+    # for each interior node, the number of descendants whose merge is not completed yet
+    children_pending = np.where(children[:, 0] < 0, 0, 2)
+
+    # nodes whose merge is completed, but whose ancestor has not been notified yet. Leaves are completed from the start
+    finished = deque(leaves.tolist())
+
+    checkpoint = None
+    restored = set()
+    if exp_options.get('checkpoint_dir') is not None:
+        checkpoint = MergeCheckpoint(exp_options['checkpoint_dir'], merge_tree, seeds, exp_options)
+        restored = set(checkpoint.completed())
+
+    # subtrees of small merges executed as a single task, see merge_subtree
+    fused = set()
+    if exp_options.get('fusion_max_flops') is not None:
+        fused = fused_subtrees(merge_tree, n_features, 2 * exp_options['max_dict_size'], exp_options['fusion_max_flops'],
+                               excluded=restored, n_dicts=len(sweep_options) if sweep else 1)
+
+    # nodes whose descendants are all completed, and that can be merged right away
+    ready = deque()
+
+    if restored or fused:
+        # the restored nodes closest to the root are completed from the start, the fused subtrees are ready from the
+        # start, and everything below them is skipped
+        finished = deque()
+        merge_total = 0
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node in restored:
+                merge_tree.merge_promise[node] = MergePromise(is_finished=True, result=checkpoint.load(node, X))
+                finished.append(node)
+            elif merge_tree.is_leaf(node):
+                finished.append(node)
+            elif node in fused:
+                merge_total = merge_total + 1
+                ready.append(node)
+            else:
+                merge_total = merge_total + 1
+                stack.extend(children[node].tolist())
+        finished = deque(sorted(finished))
+        ready = deque(sorted(ready))
+
+    # these are updated incrementally as merges are scheduled and completed
+    merge_remaining = merge_total
+    merge_running = 0
+
+    # running merges, that will be reported once they are completed. Each running node maps every copy of its merge
+    # (0 for the original, 1 for the copy launched if it straggles) to its promise and the time it was first seen
+    # started by a worker, None while it is queued
+    poll_interval = exp_options.get('poll_interval', 0.5)
+    watcher = PromiseWatcher(poll_interval=poll_interval)
+    running = {}
+
+    straggler_factor = exp_options.get('straggler_factor')
+    straggler_min_merges = exp_options.get('straggler_min_merges', 3)
+    running_inputs = {}
+
+    # the durations of the completed merges, by depth in the tree
+    depth = merge_tree.depths()
+    durations = [[] for _ in range(depth.max() + 1)]
+
+    def depth_median_duration(node_depth):
+        # the deeper merges are not larger, so they bound the duration of the shallow ones with too few samples
+        for d in range(node_depth, len(durations)):
+            if len(durations[d]) >= straggler_min_merges:
+                return np.median(durations[d])
+        return None
+
+    metrics = exp_options.get('merge_metrics')
+
     # we track the runtime of the algorithm
     start_merging_time = time.time()
 
-    # infinite loop, we will break out of it once the root's promise is completed
-    while True:
+    # loop until the root's promise is completed
+    root_finished = False
+    while not root_finished:
+
+        # notify the ancestors of all completed nodes, if the ancestor has no more pending descendants it is ready
+        while finished:
+            node = finished.popleft()
+            if not merge_tree.is_leaf(node) and node not in restored:
+                d = fetch_result(node)
+                if metrics is not None:
+                    metrics.merge_completed(node, d)
+                if checkpoint is not None:
+                    checkpoint.save(node, d)
+
+            if node == root:
+                root_finished = True
+                break
 
-        # declare the flag
-        did_something_flag = False
+            ancestor = parent[node]
+            children_pending[ancestor] = children_pending[ancestor] - 1
+            if children_pending[ancestor] == 0:
+                ready.append(ancestor)
 
-        # TODO: trasversing the merge_tree is cheap compared to running the algorithm, so we do not really optimize for now
-        for node, successors in dfs_successors(merge_tree, root).items():
+        if root_finished:
+            break
 
-            # we set the flag before all the checks
-            did_something_flag = False
+        while ready:
+            node = ready.popleft()
+            successors = children[node].tolist()
+
+            if node in fused:
+                # collect the leaves of the subtree, renumbering its nodes for merge_subtree
+                subtree = merge_tree.postorder(node)
+                position = {subtree_node: i for i, subtree_node in enumerate(subtree)}
+                subtree_children = np.full((len(subtree), 2), -1, dtype=np.intp)
+                subtree_inputs = [None] * len(subtree)
+                for i, subtree_node in enumerate(subtree):
+                    if merge_tree.is_leaf(subtree_node):
+                        subtree_inputs[i] = collect_dict(subtree_node)
+                    else:
+                        subtree_children[i] = [position[c] for c in children[subtree_node].tolist()]
+                input_dicts = [d for d in subtree_inputs if d is not None]
+
+                if metrics is not None:
+                    metrics.merge_dispatched(node, sum(input_dicts, []) if sweep else input_dicts)
+
+                # schedule the whole subtree, and assign it to its root
+                merge_promise = rpc_invoker(merge_subtree,
+                                            merge_function,
+                                            subtree_children,
+                                            subtree_inputs,
+                                            seeds[subtree],
+                                            exp_options['kernel_options'],
+                                            exp_options.get('merge_options', {}),
+                                            2 * exp_options['max_dict_size'])
+                last_merge = "last fused merge of {: 5d} leaves -> {: 5d}".format(len(input_dicts), node)
+            else:
+                merge_random_state = np.random.RandomState(seeds[node])
+
+                # collect the descendent's results
+                l_dict = collect_dict(successors[0])
+                r_dict = collect_dict(successors[1])
+
+                # if the combined budget size exceed max_dict_size, terminate since we do not want to exceed the
+                # machine memory
+                if sweep:
+                    assert all(len(l.q_i) + len(r.q_i) <= 2 * exp_options['max_dict_size']
+                               for l, r in zip(l_dict, r_dict))
+                else:
+                    assert len(l_dict.q_i) + len(r_dict.q_i) <= 2 * exp_options['max_dict_size']
+
+                if metrics is not None:
+                    metrics.merge_dispatched(node, l_dict + r_dict if sweep else [l_dict, r_dict])
+
+                # schedule the merge, and assign it to the ancestor
+                merge_promise = rpc_invoker(merge_function,
+                                            l_dict,
+                                            r_dict,
+                                            exp_options['kernel_options'],
+                                            merge_random_state,
+                                            exp_options.get('merge_options', {}))
+                last_merge = "last merge {: 5d} + {: 5d} -> {: 5d}".format(successors[0], successors[1], node)
+            merge_tree.merge_promise[node] = merge_promise
+            merge_remaining = merge_remaining - 1
+
+            if merge_promise.is_finished:
+                # synchronous executors complete the merge immediately, move on to the ancestor
+                finished.append(node)
+            else:
+                running[node] = {0: (merge_promise, None)}
+                watcher.watch((node, 0), merge_promise)
+                merge_running = len(watcher)
+                if straggler_factor is not None and node not in fused:
+                    # keep the inputs around, in case the merge needs to be launched again
+                    running_inputs[node] = (l_dict, r_dict)
 
-            # double check that the tree is not malformed
-            assert len(successors) == 2 or len(successors) == 0
+            print(
+                "merge remaining {}/{},".format(merge_remaining, merge_total)
+                + "merge currently running {},".format(merge_running)
+                + "time elapsed {},".format(str(timedelta(seconds=time.time() - start_merging_time)))
+                + last_merge
+            )
 
-            # we do not process leaves
-            if len(successors) == 0:
+        if finished:
+            continue
+
+        # launch a copy of the stragglers, and wait until the next merge would become a straggler
+        timeout = None
+        if straggler_factor is not None:
+            now = time.time()
+            for node, copies in running.items():
+                # fused subtrees are not comparable with single merges
+                if len(copies) > 1 or node in fused:
+                    continue
+
+                median_duration = depth_median_duration(depth[node])
+                if median_duration is None:
+                    continue
+
+                # merges waiting in a queue are not straggling, check again later whether they started
+                merge_promise, merge_start = copies[0]
+                if merge_start is None:
+                    if not promise_started(merge_promise):
+                        timeout = poll_interval if timeout is None else min(timeout, poll_interval)
+                        continue
+                    merge_start = now
+                    copies[0] = (merge_promise, merge_start)
+
+                time_left = merge_start + straggler_factor * median_duration - now
+                if time_left > 0:
+                    timeout = time_left if timeout is None else min(timeout, time_left)
+                    continue
+
+                l_dict, r_dict = running_inputs[node]
+                merge_promise = rpc_invoker(merge_function,
+                                            l_dict,
+                                            r_dict,
+                                            exp_options['kernel_options'],
+                                            np.random.RandomState(seeds[node]),
+                                            exp_options.get('merge_options', {}))
+                copies[1] = (merge_promise, None)
+                watcher.watch((node, 1), merge_promise)
+                print("merge {: 5d} running for {} (median {}), launched a copy".format(
+                    node, str(timedelta(seconds=now - merge_start)), str(timedelta(seconds=median_duration))))
+
+        # nothing is ready, wait for some running merge to complete (or for the next straggler)
+        completed = watcher.wait(timeout)
+        for node, copy in completed:
+            # the other copy of the merge already completed
+            if node not in running:
                 continue
 
-            # we already scheduled this merge, nothing to do on this node
-            if 'merge_promise' in merge_tree.node[node]:
-                continue
+            copies = running.pop(node)
+            running_inputs.pop(node, None)
+            merge_promise, _ = copies.pop(copy)
+            merge_tree.merge_promise[node] = merge_promise
+            if straggler_factor is not None and node not in fused:
+                # the duration measured by the worker, which excludes the time spent in a queue
+                d = fetch_result(node)
+                stats = (d[0] if sweep else d).merge_stats
+                if stats is not None and 'merge_end' in stats:
+                    durations[depth[node]].append(stats['merge_end'] - stats['merge_start'])
+
+            for other_copy, (other_promise, _) in copies.items():
+                if (node, other_copy) not in completed:
+                    watcher.discard((node, other_copy))
+                    if hasattr(other_promise, 'cancel'):
+                        other_promise.cancel()
+
+            finished.append(node)
+        merge_running = len(watcher)
+
+    # the tree was made of a single leaf
+    root_dict = collect_dict(root) if merge_tree.is_leaf(root) else fetch_result(root)
+
+    # the shared input is released once the visit returns, the dictionaries must not reference it
+    for d in (root_dict if sweep else [root_dict]):
+        d.detach()
+
+    merge_tree.merge_promise[root] = MergePromise(is_finished=True, result=root_dict)
+    return merge_tree.merge_promise[root]
+
+
+def visit_dynamic_merges(X, leaf_assigned_samples, rpc_invoker, exp_options, random_state):
+    """Computes the merges without fixing a merge tree in advance. The dictionaries that are finished (initially, one
+    per leaf) are kept in a pool, and as soon as at least two of them fit in a merge they are merged together, so that
+    a slow merge only delays the dictionaries that depend on it and workers are never idle while two dictionaries are
+    available. Up to 'merge_arity' dictionaries can be folded in a single merge (see dict_merge_many), picking the
+    smallest ones first as long as their combined size does not exceed 'max_merge_size'. The computation ends when a
+    single dictionary is left.
+
+    Since the dictionaries that are merged together depend on which merges finish first, the result is only
+    reproducible for a fixed random_state when using a synchronous rpc_invoker.
+
+    Optional fields in exp_options are, in addition to the ones used by visit_merge_tree:
+    'merge_arity': The maximum number of dictionaries merged at once (default 2)
+    'max_merge_size': The maximum number of samples in the input of a merge, if the two smallest dictionaries exceed
+        this threshold and no merge is running the algorithm aborts (default 2 * max_dict_size)
+    'merge_metrics': A MergeMetrics instance collecting statistics about each merge, merges are identified by the
+        order in which they are dispatched (default None)
+
+    Checkpointing (see MergeCheckpoint), straggler copies and sweeps over gamma are not supported.
 
-            # extract the descendent nodes
-            l_node = merge_tree.node[successors[0]]
-            r_node = merge_tree.node[successors[1]]
+    Parameters
+    ----------
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input.
+    leaf_assigned_samples : list of array
+        The indices of the samples in each initial dictionary.
+    rpc_invoker : callable
+        An invoker that satisfies the signature rpc_invoker(dict_merge_many , [merge args]) -> MergePromise.
+    exp_options : mapping of string to any
+        Dictionary containing the experiment options.
+    random_state : RandomState !!MODIFIED!!
+        RandomState instance used as the random number generator
 
-            # if one of the descendent does not contain a promise, it is not ready and nothing to do on this node
-            if 'merge_promise' not in l_node or 'merge_promise' not in r_node:
-                continue
+    Returns
+    -------
+    MergePromise containing a dictionary that well approximates the whole dataset.
+    """
+    merge_arity = exp_options.get('merge_arity', 2)
+    max_merge_size = exp_options.get('max_merge_size', 2 * exp_options['max_dict_size'])
+
+    assert merge_arity >= 2
+
+    # merges are not identified by a fixed node, so there is nothing to resume from
+    if exp_options.get('checkpoint_dir') is not None:
+        raise NotImplementedError("checkpoint_dir is only supported by visit_merge_tree")
+    if exp_options.get('straggler_factor') is not None:
+        raise NotImplementedError("straggler_factor is only supported by visit_merge_tree")
+    if np.ndim(exp_options['gamma']) > 0 or np.ndim(exp_options['vareps']) > 0:
+        raise NotImplementedError("sweeps over gamma are only supported by visit_merge_tree")
+
+    X, index_dicts = share_input(X, rpc_invoker, exp_options)
+
+    # the pool of finished dictionaries, as a heap of (size, insertion order, is_leaf, dictionary or leaf samples).
+    # Leaves are loaded only when needed, see leaf_dict
+    insertion_order = 0
+    available = []
+    for samples in leaf_assigned_samples:
+        available.append((samples.shape[0], insertion_order, True, samples))
+        insertion_order = insertion_order + 1
+    heapq.heapify(available)
+
+    def collect_dict(item):
+        _, _, is_leaf, content = item
+        if is_leaf:
+            return leaf_dict(X, content, exp_options, index_dicts=index_dicts)
+        return content
+
+    # running merges, that will be reported once they are completed
+    running = {}
+    watcher = PromiseWatcher(poll_interval=exp_options.get('poll_interval', 0.5))
+    merge_count = 0
+
+    metrics = exp_options.get('merge_metrics')
 
-            # if one of the descendent's promise is not done, it is not ready and nothing to do on this node
-            if not l_node['merge_promise'].is_finished or not r_node['merge_promise'].is_finished:
-                continue
+    # we track the runtime of the algorithm
+    start_merging_time = time.time()
+
+    while True:
+        while len(available) >= 2:
+            # greedily group the smallest dictionaries, as long as they fit in a merge
+            group = [heapq.heappop(available)]
+            group_size = group[0][0]
+            while available and len(group) < merge_arity and group_size + available[0][0] <= max_merge_size:
+                group.append(heapq.heappop(available))
+                group_size = group_size + group[-1][0]
+
+            # not even the two smallest dictionaries fit, wait for the running merges to shrink the pool
+            if len(group) == 1:
+                heapq.heappush(available, group[0])
+                break
 
-            # we cannot pass directly random_state to the rpc_invoker call, since the rpc could be executed on a remote
-            # machine where modification to random_state do not propagate and compromise reproducibility
-            # instead, we send over a reproducible random seed and expect the remote system to use it to initialize
-            # a local reproducible rng
-            merge_random_state = np.random.RandomState(
-                random_state.randint(np.iinfo(np.uint32).min + 10,
-                                     high=np.iinfo(np.uint32).max - 10))
-
-            # unwrap the descendent's results (leaf nodes were wrapped too)
-            l_dict = l_node['merge_promise'].result
-            r_dict = r_node['merge_promise'].result
-
-            # if the combined budget size exceed max_dict_size, terminate since we do not want to exceed the machine
-            # memory
-            assert len(l_dict.q_i) + len(r_dict.q_i) <= 2 * exp_options['max_dict_size']
-
-            # schedule the merge, and assign it to the ancestor
-            merge_tree.node[node]['merge_promise'] = rpc_invoker(dict_merge,
-                                                                 l_dict,
-                                                                 r_dict,
-                                                                 exp_options['kernel_options'],
-                                                                 merge_random_state)
-            # we did something, let the printing function know
-            did_something_flag = True
-
-        # we did something, time to log some statistics
-        if did_something_flag:
-            # how many merges are currently going on
-            merge_running = 0
-            for node_count_merges in merge_tree.nodes_iter():
-                if ('merge_promise' in merge_tree.node[node_count_merges]
-                        and not merge_tree.node[node_count_merges]['merge_promise'].is_finished):
-                    merge_running = merge_running + 1
-
-            # how many are left before the end
-            merge_remaining = 0
-            for node_count_merges in merge_tree.nodes_iter():
-                if 'merge_promise' not in merge_tree.node[node_count_merges]:
-                    merge_remaining = merge_remaining + 1
+            input_dicts = [collect_dict(item) for item in group]
+            if metrics is not None:
+                metrics.merge_dispatched(merge_count, input_dicts)
+
+            merge_promise = rpc_invoker(dict_merge_many,
+                                        input_dicts,
+                                        exp_options['kernel_options'],
+                                        new_merge_random_state(random_state),
+                                        exp_options.get('merge_options', {}))
+
+            if merge_promise.is_finished:
+                # synchronous executors complete the merge immediately, the result can be merged right away
+                d_top = merge_promise.result
+                if metrics is not None:
+                    metrics.merge_completed(merge_count, d_top)
+                heapq.heappush(available, (len(d_top.q_i), insertion_order, False, d_top))
+                insertion_order = insertion_order + 1
+            else:
+                running[merge_count] = merge_promise
+                watcher.watch(merge_count, merge_promise)
+            merge_count = merge_count + 1
 
             print(
-                "merge remaining {}/{},".format(merge_remaining, merge_total)
-                + "merge currently running {},".format(merge_running)
+                "dictionaries remaining {},".format(len(available) + len(running))
+                + "merge currently running {},".format(len(running))
                 + "time elapsed {},".format(str(timedelta(seconds=time.time() - start_merging_time)))
-                + "last merge {: 5d} + {: 5d} -> {: 5d}".format(successors[0], successors[1], node)
+                + "last merge {} -> {: 5d}".format(" + ".join("{: 5d}".format(item[0]) for item in group),
+                                                   merge_count - 1)
             )
-        else:
-            # if we did nothing, sleep a bit to avoid wasting CPU cycles. the user can also enjoy half second of rest
-            time.sleep(0.5)
 
-        # we are done, bail out
-        if 'merge_promise' in merge_tree.node[root] and merge_tree.node[root]['merge_promise'].is_finished:
+        if not running:
             break
 
-    return merge_tree.node[root]['merge_promise']
+        # wait for some running merge to complete, and add its result to the pool
+        for key in watcher.wait():
+            d_top = running.pop(key).result
+            if metrics is not None:
+                metrics.merge_completed(key, d_top)
+            heapq.heappush(available, (len(d_top.q_i), insertion_order, False, d_top))
+            insertion_order = insertion_order + 1
+
+    # if the combined budget size exceed max_merge_size, terminate since we do not want to exceed the machine memory
+    assert len(available) == 1
+
+    # the shared input is released once the visit returns, the dictionary must not reference it
+    return MergePromise(is_finished=True, result=collect_dict(available[0]).detach())
+
+
+def shutdown_rpc_invoker(rpc_invoker):
+    """Releases the workers of an invoker that exposes a shutdown() method, see get_rpc_invoker.
+
+    Parameters
+    ----------
+    rpc_invoker : callable
+        The invoker.
+    """
+    if hasattr(rpc_invoker, 'shutdown'):
+        rpc_invoker.shutdown()
 
 
 def squeak(X, exp_options, random_state=None):
@@ -415,8 +3009,8 @@ def squeak(X, exp_options, random_state=None):
 
     Parameters
     ----------
-    X : array, shape (q, n_features)
-        Input samples.
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input for the supported formats.
     exp_options : mapping of string to any
         Dictionary containing the experiment options, see visit_merge_tree and get_rpc_invoker.
     random_state : RandomState (optional, default=None)
@@ -425,38 +3019,29 @@ def squeak(X, exp_options, random_state=None):
 
     Returns
     -------
-    MergePromise containing a dictionary that well approximates the whole dataset.
+    MergePromise containing a dictionary that well approximates the whole dataset (a list of dictionaries for a sweep
+    over gamma, see visit_merge_tree).
     """
     if not random_state:
         random_state = np.random.RandomState(42)
 
+    X = as_input(X)
+
     n = float(X.shape[0])  # number of samples
     m = exp_options['max_dict_size']
     k = int(np.ceil(n / m))  # number of initial chunks
 
-    # randomly assign samples to chunks
-    perm_idx = np.array_split(random_state.permutation(int(n)), k)
-
-    # to construct a fully unbalanced tree with k leaves, first we create a line graph with k nodes
-    merge_tree = path_graph(k, create_using=DiGraph())
-    root = min(merge_tree.nodes_iter())
-
-    # the end of the chain is a leaf, so we assign it the last chunk
-    end_of_chain = max(merge_tree.nodes_iter())
-    merge_tree.node[end_of_chain]['leaf_assigned_samples'] = perm_idx[k - 1]
-
-    # for all the other chunks we look for a (non-leaf) node that does not have samples assigned
-    # and also does not have a leaf attached, and attach a leaf with the associated chunk
-    for i in range(k - 1):
-        for node, successors in dfs_successors(merge_tree, root).items():
-            if 'leaf_assigned_samples' not in merge_tree.node[node] and len(successors) < 2:
-                merge_tree.add_node(end_of_chain + i + 1, leaf_assigned_samples=perm_idx[i])
-                merge_tree.add_edge(node, end_of_chain + i + 1)
-                # after we add the node, we have to break, we do not want to add the i-th chunk too many times
-                break
+    # randomly assign samples to chunks, the samples of a chunk are sorted so that they can be read sequentially
+    perm_idx = [np.sort(chunk) for chunk in np.array_split(random_state.permutation(int(n)), k)]
+
+    # construct a fully unbalanced tree with k leaves, see MergeTree.sequential
+    merge_tree = MergeTree.sequential(perm_idx)
 
     rpc_invoker = get_rpc_invoker(**exp_options['rpc_invoker_options'])
-    root_dict_promise = visit_merge_tree(X, merge_tree, root, rpc_invoker, exp_options, random_state)
+    try:
+        root_dict_promise = visit_merge_tree(X, merge_tree, merge_tree.root, rpc_invoker, exp_options, random_state)
+    finally:
+        shutdown_rpc_invoker(rpc_invoker)
 
     return root_dict_promise
 
@@ -464,10 +3049,13 @@ def squeak(X, exp_options, random_state=None):
 def disqueak(X, exp_options, random_state=None):
     """Invokes visit_merge_tree with a completely balanced (fully parallel) tree. See visit_merge_tree for more details
 
+    If exp_options['merge_schedule'] is 'dynamic' (default 'tree'), the merges are instead scheduled as soon as any
+    dictionaries are ready, see visit_dynamic_merges.
+
     Parameters
     ----------
-    X : array, shape (q, n_features)
-        Input samples.
+    X : array-like, shape (n, n_features)
+        Input samples, see as_input for the supported formats.
     exp_options : mapping of string to any
         Dictionary containing the experiment options, see visit_merge_tree and get_rpc_invoker.
     random_state : RandomState (optional, default=None)
@@ -476,11 +3064,14 @@ def disqueak(X, exp_options, random_state=None):
 
     Returns
     -------
-    MergePromise containing a dictionary that well approximates the whole dataset.
+    MergePromise containing a dictionary that well approximates the whole dataset (a list of dictionaries for a sweep
+    over gamma, see visit_merge_tree).
     """
     if not random_state:
         random_state = np.random.RandomState(42)
 
+    X = as_input(X)
+
     n = float(X.shape[0])  # number of samples
     m = exp_options['max_dict_size']
     k = int(np.ceil(n / m))  # number of initial chunks
@@ -488,53 +3079,604 @@ def disqueak(X, exp_options, random_state=None):
     if k % 2:
         k += 1  # make it even
 
-    # randomly assign samples to chunks
-    perm_idx = np.array_split(random_state.permutation(int(n)), k)
+    # randomly assign samples to chunks, the samples of a chunk are sorted so that they can be read sequentially
+    perm_idx = [np.sort(chunk) for chunk in np.array_split(random_state.permutation(int(n)), k)]
 
     # we need to fit k chunks in a tree that:
     # (1) is balanced, each node has exactly two descendant or zero (leaf)
     # (2) holds data only in leaves
     # (3) has a difference between the minimum and maximum path in the tree smaller or equal than 1 (in worst case, only
     #       one round difference between best and worst path)
-    # To obtain this we compute h, the closest power of two smaller than the number of leaves
+    # see MergeTree.balanced
+    merge_tree = MergeTree.balanced(perm_idx)
 
-    h = int(np.floor(np.log2(k)))
+    rpc_invoker = get_rpc_invoker(**exp_options['rpc_invoker_options'])
+    try:
+        if exp_options.get('merge_schedule', 'tree') == 'dynamic':
+            return visit_dynamic_merges(X, perm_idx, rpc_invoker, exp_options, random_state)
+        assert exp_options.get('merge_schedule', 'tree') == 'tree'
+        root_dict_promise = visit_merge_tree(X, merge_tree, merge_tree.root, rpc_invoker, exp_options, random_state)
+    finally:
+        shutdown_rpc_invoker(rpc_invoker)
 
-    # create a complete binary tree of depth h
+    return root_dict_promise
 
-    merge_tree = balanced_tree(2, h, create_using=DiGraph())
 
-    # compute diff, the difference between the number of leaves we want to insert k and the available leaves 2**h
+def iter_squeak_stream(chunks, exp_options, random_state=None):
+    """Runs SQUEAK over a stream of samples, folding each new chunk into the current dictionary with dict_merge.
+    This is the same sequential merge tree used by squeak, but only the current dictionary and one chunk are kept in
+    memory, so the memory is bounded by max_dict_size instead of the number of samples. Unlike squeak, the samples are
+    not randomly permuted, and are processed in the order they are streamed.
 
-    diff = k - 2 ** h
+    Chunks larger than max_dict_size are split, and a chunk can have any size. The indices stored in the dictionaries
+    (SampleDict.idx) refer to the position of each sample in the stream.
 
-    # find all leaves
-    leaves = [leaf for leaf in merge_tree.nodes_iter() if merge_tree.out_degree(leaf) == 0]
+    Parameters
+    ----------
+    chunks : iterable of array, shape (n_i, n_features)
+        The stream of input samples, e.g. a generator reading batches from disk.
+    exp_options : mapping of string to any
+        Dictionary containing the experiment options, see visit_merge_tree and get_rpc_invoker.
+    random_state : RandomState (optional, default=None)
+        RandomState instance used as the random number generator. If None, gets automatically initialized to
+        a fixed number.
 
-    # then we assign all chunks to the leaves. since we reserved 2**h leaves instead of k, for the first diff
-    # rounds we simply add two descendent. every time we do this, we reduce diff by one (since we processed two chunks
-    # instead of one) until we have no more difference and we can directly assign to the leaves
-    k_i = 0
-    node_i = max(merge_tree.nodes_iter())
-    for leaf in leaves:
-        if diff == 0:
-            # we are done with extra chunks, simply assign
-            merge_tree.node[leaf]['leaf_assigned_samples'] = perm_idx[k_i]
-            k_i = k_i + 1
-        else:
-            # we do not have enough space to directly assign, add two descendants to the current node and assign
-            # to those instead
-            merge_tree.add_node(node_i + 1, leaf_assigned_samples=perm_idx[k_i])
-            merge_tree.add_node(node_i + 2, leaf_assigned_samples=perm_idx[k_i + 1])
-            merge_tree.add_edge(leaf, node_i + 1)
-            merge_tree.add_edge(leaf, node_i + 2)
-            node_i = node_i + 2
-            k_i = k_i + 2
-
-            # the number of leftover leaves get closer to the right one
-            diff = diff - 1
+    Yields
+    ------
+    d : SampleDict
+        The dictionary that well approximates all samples streamed so far, after each input chunk.
+    """
+    if not random_state:
+        random_state = np.random.RandomState(42)
 
+    m = exp_options['max_dict_size']
     rpc_invoker = get_rpc_invoker(**exp_options['rpc_invoker_options'])
-    root_dict_promise = visit_merge_tree(X, merge_tree, 0, rpc_invoker, exp_options, random_state)
 
-    return root_dict_promise
+    try:
+        d_current = None
+        n_seen = 0
+        for chunk in chunks:
+            for start in range(0, chunk.shape[0], m):
+                leaf_samples = np.arange(min(m, chunk.shape[0] - start))
+                d_leaf = leaf_dict(chunk[start:start + m], leaf_samples, exp_options)
+                # make the indices refer to the whole stream
+                d_leaf.idx = leaf_samples + n_seen
+                n_seen = n_seen + leaf_samples.shape[0]
+
+                # the first chunk stores all samples, and is already accurate
+                if d_current is None:
+                    d_current = d_leaf
+                    continue
+
+                # if the combined budget size exceed max_dict_size, terminate since we do not want to exceed the
+                # machine memory
+                assert len(d_current.q_i) + len(d_leaf.q_i) <= 2 * m
+
+                d_current = wait_promise(rpc_invoker(dict_merge,
+                                                     d_current,
+                                                     d_leaf,
+                                                     exp_options['kernel_options'],
+                                                     new_merge_random_state(random_state),
+                                                     exp_options.get('merge_options', {})),
+                                         poll_interval=exp_options.get('poll_interval', 0.5))
+
+            if d_current is not None:
+                yield d_current
+    finally:
+        # also executed when the caller stops consuming the stream
+        shutdown_rpc_invoker(rpc_invoker)
+
+
+def squeak_stream(chunks, exp_options, random_state=None):
+    """Runs SQUEAK over a stream of samples, see iter_squeak_stream for more details
+
+    Parameters
+    ----------
+    chunks : iterable of array, shape (n_i, n_features)
+        The stream of input samples, e.g. a generator reading batches from disk.
+    exp_options : mapping of string to any
+        Dictionary containing the experiment options, see visit_merge_tree and get_rpc_invoker.
+    random_state : RandomState (optional, default=None)
+        RandomState instance used as the random number generator. If None, gets automatically initialized to
+        a fixed number.
+
+    Returns
+    -------
+    MergePromise containing a dictionary that well approximates the whole stream.
+    """
+    d_current = None
+    for d_current in iter_squeak_stream(chunks, exp_options, random_state):
+        pass
+
+    # double check that the stream was not empty
+    assert d_current is not None
+
+    return MergePromise(is_finished=True, result=d_current)
+
+
+#####################################################
+# Using the dictionary                              #
+#####################################################
+
+def iter_batches(n, batch_size):
+    """Splits the range [0, n) in contiguous batches.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples.
+    batch_size : int
+        Maximum number of samples in a batch.
+
+    Returns
+    -------
+    batches : list of (int, int)
+        The start and stop of each batch.
+    """
+    return [(start, min(start + batch_size, n)) for start in range(0, n, batch_size)]
+
+
+def for_each_batch(fn, batches, n_jobs=1):
+    """Calls a function on each batch, sequentially or in a pool of threads. The kernel and matrix products release
+    the GIL, so batches that write their result in a shared output run in parallel.
+
+    Parameters
+    ----------
+    fn : callable
+        The function, called with each batch.
+    batches : list of (int, int)
+        The batches, see iter_batches.
+    n_jobs : int (optional, default=1)
+        Number of threads. If 1, the batches are processed in order in the current thread.
+    """
+    if n_jobs == 1:
+        for batch in batches:
+            fn(batch)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            # consume the results to propagate exceptions
+            list(executor.map(fn, batches))
+
+
+class NystromFeatureMap(object):
+    """Maps samples to the finite dimensional feature space of the Nystrom approximation defined by a dictionary.
+
+    Given the dictionary samples D with weights S (see dict_weights), the map is
+    phi(x) = (S K_DD S + reg I)^(-1/2) S k_D(x)
+    so that phi(x)^T phi(y) approximates k(x, y). With reg=0 the inverse is replaced by the pseudo-inverse, and the
+    approximation is the classical (unregularized) Nystrom one. The factorization of the weighted dictionary kernel is
+    computed once when the map is created, after which each batch of samples only costs a (batch x q) kernel
+    evaluation and a (batch x q) times (q x n_components) product.
+
+    Parameters
+    ----------
+    d : SampleDict
+        The dictionary, e.g. the result of squeak or disqueak.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword
+        arguments). Should be the same used to build the dictionary.
+    reg : float (optional, default=0.)
+        Regularization added to the weighted dictionary kernel.
+    rcond : float (optional, default=1e-10)
+        Eigenvalues smaller than rcond times the largest one are discarded when reg=0.
+    batch_size : int (optional, default=1024)
+        Number of samples mapped at once, bounds the memory used by transform.
+    n_jobs : int (optional, default=1)
+        Number of threads used by transform. The kernel and matrix products release the GIL.
+
+    Attributes
+    ----------
+    X_dict : array, shape (q, n_features)
+        The dictionary samples.
+    s : array, shape (q,)
+        The dictionary weights.
+    projection : array, shape (q, n_components)
+        The cached factorization, phi(x) = (s * k_D(x)) projection.
+    n_components : int
+        Dimension of the feature space.
+    """
+
+    def __init__(self, d, kernel_options, reg=0., rcond=1e-10, batch_size=1024, n_jobs=1):
+        self.kernel_options = kernel_options
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+        self.X_dict = d.get_X()
+        self.s = dict_weights(d)
+
+        SKS = self.s[:, np.newaxis] * dict_kernel(d, kernel_options) * self.s
+        eigvals, eigvecs = scipy.linalg.eigh(SKS, overwrite_a=True)
+
+        if reg > 0:
+            keep = eigvals > -reg
+        else:
+            keep = eigvals > rcond * eigvals.max()
+
+        self.projection = eigvecs[:, keep] / np.sqrt(eigvals[keep] + reg)
+        self.n_components = self.projection.shape[1]
+
+    def transform(self, X, out=None):
+        """Maps samples to the feature space, in batches of batch_size samples.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, n_features)
+            Samples to map, see as_input for the supported formats. Batches are read as contiguous slices.
+        out : array, shape (n, n_components) (optional, default=None) !!MODIFIED!!
+            Where to store the features, e.g. a np.memmap when they do not fit in memory. If None, a new array is
+            allocated.
+
+        Returns
+        -------
+        out : array, shape (n, n_components)
+            The mapped samples.
+        """
+        X = as_input(X)
+        n = X.shape[0]
+
+        if out is None:
+            out = np.empty((n, self.n_components))
+        assert out.shape == (n, self.n_components)
+
+        def transform_batch(batch):
+            start, stop = batch
+            out[start:stop] = (kernel_block(X[start:stop], self.X_dict, self.kernel_options) * self.s).dot(
+                self.projection)
+
+        for_each_batch(transform_batch, iter_batches(n, self.batch_size), n_jobs=self.n_jobs)
+
+        return out
+
+
+def kernel_diag(X, kernel_options):
+    """Evaluates the kernel between each sample and itself.
+
+    Parameters
+    ----------
+    X : array, shape (n, n_features)
+        Samples.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword arguments).
+
+    Returns
+    -------
+    k : array, shape (n,)
+        The values k(x_i, x_i).
+    """
+    metric = kernel_options.get('metric', 'linear')
+
+    # the kernels that only depend on the distance between the samples are 1 on the diagonal
+    if metric in ('rbf', 'laplacian', 'chi2'):
+        return np.ones(X.shape[0])
+
+    if metric not in DOT_PRODUCT_METRICS:
+        # other kernels (e.g. callables) are evaluated one sample at a time
+        return np.array([kernel_block(X[i:i + 1], None, kernel_options)[0, 0] for i in range(X.shape[0])])
+
+    # the dot product kernels are functions of the squared norm of each sample
+    if scipy.sparse.issparse(X):
+        sq_norms = np.asarray(X.multiply(X).sum(axis=1), dtype=float).ravel()
+    else:
+        sq_norms = np.einsum('ij,ij->i', X, X, dtype=float)
+
+    # same defaults as sklearn
+    gamma = kernel_options.get('gamma')
+    if gamma is None:
+        gamma = 1. / X.shape[1]
+    coef0 = kernel_options.get('coef0', 1)
+
+    if metric == 'linear':
+        return sq_norms
+    elif metric in ('poly', 'polynomial'):
+        return (gamma * sq_norms + coef0) ** kernel_options.get('degree', 3)
+    elif metric == 'sigmoid':
+        return np.tanh(gamma * sq_norms + coef0)
+    else:
+        # cosine, samples with a zero norm are left to zero
+        return (sq_norms > 0).astype(float)
+
+
+class RLSEstimator(object):
+    """Estimates the gamma-Ridge Leverage Scores (RLS) of arbitrary samples using a dictionary, to vareps precision.
+
+    For a sample x, the estimator is
+    tau(x) = (1 - 2 vareps) / gamma * (k(x, x) - k_D(x)^T S (S K_DD S + gamma I)^-1 S k_D(x))
+    which for samples in the dictionary coincides with the one used by estimate_tau. The Cholesky factor of
+    S K_DD S + gamma I is computed once when the estimator is created, after which each block of samples only costs a
+    (q x block) kernel evaluation and a triangular solve.
+
+    Parameters
+    ----------
+    d : SampleDict
+        The dictionary, e.g. the result of squeak or disqueak.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword
+        arguments). Should be the same used to build the dictionary.
+
+    Attributes
+    ----------
+    X_dict : array, shape (q, n_features)
+        The dictionary samples.
+    s : array, shape (q,)
+        The dictionary weights.
+    L : array, shape (q, q)
+        Lower Cholesky factor of S K_DD S + gamma I.
+    gamma : float
+        The regularization parameter of the RLS.
+    vareps : float
+        The accuracy parameter of the RLS.
+    """
+
+    def __init__(self, d, kernel_options):
+        self.kernel_options = kernel_options
+        self.gamma = d.gamma
+        self.vareps = d.vareps
+
+        self.X_dict = d.get_X()
+        self.s = dict_weights(d)
+
+        SKS = self.s[:, np.newaxis] * dict_kernel(d, kernel_options) * self.s
+        np.fill_diagonal(SKS, SKS.diagonal() + self.gamma)
+        self.L = scipy.linalg.cholesky(SKS, lower=True, overwrite_a=True)
+
+    def score_block(self, X):
+        """Estimates the RLS of a block of samples.
+
+        Parameters
+        ----------
+        X : array, shape (n_block, n_features)
+            Samples to score.
+
+        Returns
+        -------
+        tau : array, shape (n_block,)
+            The estimated RLS.
+        """
+        B = scipy.linalg.solve_triangular(self.L, (kernel_block(X, self.X_dict, self.kernel_options) * self.s).T,
+                                          lower=True, overwrite_b=True)
+
+        tau = (1. - 2 * self.vareps) / self.gamma * (kernel_diag(X, self.kernel_options) - np.einsum('ij,ij->j', B, B))
+
+        # the difference can become slightly negative due to rounding errors
+        return np.maximum(tau, 0.)
+
+    def score(self, X, batch_size=1024, rpc_invoker=None, n_tasks=None):
+        """Estimates the RLS of all samples, in blocks of batch_size samples.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, n_features)
+            Samples to score, see as_input for the supported formats. Blocks are read as contiguous slices.
+        batch_size : int (optional, default=1024)
+            Number of samples scored at once, bounds the memory used by each block.
+        rpc_invoker : callable (optional, default=None)
+            An invoker returned by get_rpc_invoker, used to score the blocks in parallel. The blocks are grouped in
+            n_tasks tasks of contiguous blocks, so that the estimator is only sent once per task (once per worker with
+            dask, which broadcasts it, see get_rpc_invoker). Tasks only receive their task boundaries if X can be
+            shared with the workers, either by the invoker (see get_rpc_invoker) or by reference (e.g. a MemmapArray),
+            and their own slice of X otherwise. If None, the blocks are scored sequentially in the current process.
+        n_tasks : int (optional, default=None)
+            Number of tasks sent to the rpc_invoker. If None, four per worker of the invoker, or per local core if the
+            invoker does not know its number of workers.
+
+        Returns
+        -------
+        tau : array, shape (n,)
+            The estimated RLS.
+        """
+        X = as_input(X)
+        n = X.shape[0]
+
+        tau = np.empty(n)
+        if rpc_invoker is None:
+            for start, stop in iter_batches(n, batch_size):
+                tau[start:stop] = self.score_block(X[start:stop])
+        else:
+            shared_X = rpc_invoker.share_input(X) if hasattr(rpc_invoker, 'share_input') else None
+            if shared_X is None and isinstance(X, MemmapArray):
+                shared_X = X
+
+            if n_tasks is None:
+                n_tasks = 4 * getattr(rpc_invoker, 'n_workers', os.cpu_count())
+            batches_per_task = -(-len(iter_batches(n, batch_size)) // n_tasks)
+            tasks = iter_batches(n, batches_per_task * batch_size)
+
+            estimator = rpc_invoker.share_object(self) if hasattr(rpc_invoker, 'share_object') else self
+
+            promises = []
+            for start, stop in tasks:
+                if shared_X is not None:
+                    promises.append(rpc_invoker(score_rls_block, estimator, shared_X, start, stop, batch_size))
+                else:
+                    promises.append(rpc_invoker(score_rls_block, estimator, X[start:stop], 0, stop - start,
+                                                batch_size))
+            for (start, stop), promise in zip(tasks, promises):
+                tau[start:stop] = wait_promise(promise)
+
+        return tau
+
+
+def score_rls_block(rls_estimator, X, start, stop, batch_size=None):
+    """Estimates the RLS of the samples X[start:stop], in blocks of batch_size samples, see RLSEstimator.score. This is
+    the function executed by the rpc_invoker, and must stay at the module level to be picklable.
+
+    Parameters
+    ----------
+    rls_estimator : RLSEstimator
+        The estimator.
+    X : array-like, shape (n, n_features)
+        Input samples.
+    start : int
+        First sample of the range.
+    stop : int
+        End (excluded) of the range.
+    batch_size : int (optional, default=None)
+        Number of samples scored at once. If None, the whole range is scored at once.
+
+    Returns
+    -------
+    tau : array, shape (stop - start,)
+        The estimated RLS.
+    """
+    if batch_size is None:
+        return rls_estimator.score_block(X[start:stop])
+
+    tau = np.empty(stop - start)
+    for batch_start, batch_stop in iter_batches(stop - start, batch_size):
+        tau[batch_start:batch_stop] = rls_estimator.score_block(X[start + batch_start:start + batch_stop])
+    return tau
+
+
+class NystromRidgeRegression(object):
+    """Kernel ridge regression restricted to the Nystrom feature space defined by a dictionary.
+
+    With the features phi(x) of a NystromFeatureMap, the estimator solves
+    w = argmin ||Phi w - y||^2 + gamma ||w||^2 = (Phi^T Phi + gamma I)^-1 Phi^T y
+    and predicts f(x) = phi(x)^T w. Phi^T Phi and Phi^T y are accumulated over batches of samples, so the training set
+    is never mapped as a whole and can be memmapped. The eigendecomposition of Phi^T Phi is cached, so that refit can
+    change gamma at the cost of an (n_components x n_components) times (n_components x n_targets) product, without
+    reading the samples again. Predictions are computed directly from the dictionary kernel, as
+    f(x) = (s * k_D(x)) coef, where coef = projection w is cached as well.
+
+    Parameters
+    ----------
+    d : SampleDict
+        The dictionary, e.g. the result of squeak or disqueak.
+    kernel_options : mapping of string to any
+        Dictionary containing the kernel function used as a similarity, with all associated parameters (keyword
+        arguments). Should be the same used to build the dictionary.
+    gamma : float (optional, default=None)
+        The regularization parameter. If None, the gamma of the dictionary is used, which is the regularization the
+        dictionary guarantees an accurate approximation for.
+    rcond : float (optional, default=1e-10)
+        See NystromFeatureMap.
+    batch_size : int (optional, default=1024)
+        Number of samples mapped at once, bounds the memory used by fit and predict.
+    n_jobs : int (optional, default=1)
+        Number of threads used by fit and predict. The kernel and matrix products release the GIL.
+
+    Attributes
+    ----------
+    feature_map : NystromFeatureMap
+        The (unregularized) feature map of the dictionary.
+    eigvals : array, shape (n_components,)
+        The eigenvalues of Phi^T Phi.
+    eigvecs : array, shape (n_components, n_components)
+        The eigenvectors of Phi^T Phi.
+    Phi_y : array, shape (n_components, n_targets)
+        The eigenvectors times Phi^T y.
+    coef : array, shape (q, n_targets)
+        The coefficients of the weighted dictionary kernel, f(x) = (s * k_D(x)) coef.
+    """
+
+    def __init__(self, d, kernel_options, gamma=None, rcond=1e-10, batch_size=1024, n_jobs=1):
+        self.gamma = d.gamma if gamma is None else gamma
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+        self.feature_map = NystromFeatureMap(d, kernel_options, rcond=rcond, batch_size=batch_size, n_jobs=n_jobs)
+
+        self.eigvals = None
+        self.eigvecs = None
+        self.Phi_y = None
+        self.coef = None
+        self.y_ndim = None
+
+    def fit(self, X, y):
+        """Fits the regression weights, reading the samples in batches of batch_size * n_jobs samples.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, n_features)
+            Training samples, see as_input for the supported formats. Batches are read as contiguous slices.
+        y : array, shape (n,) or (n, n_targets)
+            Training targets, one column per target. Batches are read as contiguous slices.
+
+        Returns
+        -------
+        self : NystromRidgeRegression
+        """
+        X = as_input(X)
+        n = X.shape[0]
+        assert y.shape[0] == n
+        assert y.ndim in (1, 2)
+
+        self.y_ndim = y.ndim
+        n_targets = 1 if y.ndim == 1 else y.shape[1]
+        n_components = self.feature_map.n_components
+
+        Phi_Phi = np.zeros((n_components, n_components))
+        Phi_y = np.zeros((n_components, n_targets))
+
+        # the feature map splits each chunk between its threads
+        for start, stop in iter_batches(n, self.batch_size * self.n_jobs):
+            Phi = self.feature_map.transform(X[start:stop])
+            Phi_Phi += Phi.T.dot(Phi)
+            Phi_y += Phi.T.dot(np.asarray(y[start:stop], dtype=float).reshape(stop - start, n_targets))
+
+        self.eigvals, self.eigvecs = scipy.linalg.eigh(Phi_Phi, overwrite_a=True)
+        self.Phi_y = self.eigvecs.T.dot(Phi_y)
+
+        return self.refit(self.gamma)
+
+    def refit(self, gamma):
+        """Changes the regularization parameter, reusing the eigendecomposition cached by fit.
+
+        Parameters
+        ----------
+        gamma : float
+            The new regularization parameter.
+
+        Returns
+        -------
+        self : NystromRidgeRegression
+        """
+        assert self.eigvals is not None, 'fit must be called before refit'
+        assert gamma > 0
+
+        self.gamma = gamma
+
+        # Phi^T Phi is positive semi-definite, clip the eigenvalues that rounding errors made slightly negative
+        w = self.eigvecs.dot(self.Phi_y / (np.maximum(self.eigvals, 0.) + gamma)[:, np.newaxis])
+        self.coef = self.feature_map.projection.dot(w)
+
+        return self
+
+    def predict(self, X, out=None):
+        """Predicts the targets of samples, in batches of batch_size samples.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, n_features)
+            Samples, see as_input for the supported formats. Batches are read as contiguous slices.
+        out : array, shape (n,) or (n, n_targets) (optional, default=None)
+            Where to store the predictions, e.g. a np.memmap when they do not fit in memory. Must have the same number
+            of dimensions as the targets passed to fit. If None, a new array is allocated.
+
+        Returns
+        -------
+        out : array, shape (n,) or (n, n_targets)
+            The predicted targets.
+        """
+        assert self.coef is not None, 'fit must be called before predict'
+
+        X = as_input(X)
+        n = X.shape[0]
+        n_targets = self.coef.shape[1]
+        shape = (n,) if self.y_ndim == 1 else (n, n_targets)
+
+        if out is None:
+            out = np.empty(shape)
+        assert out.shape == shape
+
+        feature_map = self.feature_map
+
+        def predict_batch(batch):
+            start, stop = batch
+            f = (kernel_block(X[start:stop], feature_map.X_dict, feature_map.kernel_options) * feature_map.s).dot(
+                self.coef)
+            out[start:stop] = f.reshape((stop - start,) + shape[1:])
+
+        for_each_batch(predict_batch, iter_batches(n, self.batch_size), n_jobs=self.n_jobs)
+
+        return out
@@ -0,0 +1,459 @@
+"""Benchmarks for squeak.py on synthetic data.
+
+Runs squeak, disqueak, dict_merge and estimate_tau over a grid of problem sizes, kernels, tree shapes and backends,
+and stores one JSON line per run with its wall time, peak memory and final dictionary size, together with the versions
+of the numerical libraries. Each run is executed in a fresh process, so that the peak memory of one run does not leak
+into the next one.
+
+Usage:
+    python squeak_benchmark.py run --output results.jsonl [--quick] [--n 10000 20000] [--backend sync threads] ...
+    python squeak_benchmark.py report results.jsonl
+    python squeak_benchmark.py compare baseline.jsonl results.jsonl [--threshold 1.2]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import squeak  # noqa: E402
+
+# the parameters identifying a run, runs with the same parameters are compared across result files
+CONFIG_KEYS = ('benchmark', 'n', 'n_features', 'max_dict_size', 'gamma', 'kernel', 'shape', 'backend')
+
+# the function benchmarked for each tree shape
+SHAPES = ('sequential', 'balanced', 'dynamic')
+
+KERNELS = {'rbf': {'metric': 'rbf', 'gamma': 0.1},
+           'laplacian': {'metric': 'laplacian', 'gamma': 0.1},
+           'linear': {'metric': 'linear'},
+           'poly': {'metric': 'poly', 'degree': 2, 'gamma': 0.1, 'coef0': 1.}}
+
+BACKENDS = {'sync': {'async_eval': False},
+            'threads': {'backend': 'threads'},
+            'processes': {'backend': 'processes'}}
+
+DEFAULT_GRID = {'n': [5000, 20000],
+                'n_features': [10, 100],
+                'max_dict_size': [500, 1000],
+                'gamma': [1., 10.],
+                'kernel': ['rbf'],
+                'shape': list(SHAPES),
+                'backend': ['sync', 'threads', 'processes']}
+
+QUICK_GRID = {'n': [2000],
+              'n_features': [10],
+              'max_dict_size': [200],
+              'gamma': [10.],
+              'kernel': ['rbf'],
+              'shape': list(SHAPES),
+              'backend': ['sync', 'threads']}
+
+
+def make_data(n, n_features, random_state):
+    """Generates a mixture of Gaussians, so that the RLS are not uniform.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples.
+    n_features : int
+        Number of features.
+    random_state : RandomState
+        RandomState instance used as the random number generator.
+
+    Returns
+    -------
+    X : array, shape (n, n_features)
+        The samples.
+    """
+    centers = random_state.randn(10, n_features) * 3.
+    return centers[random_state.randint(10, size=n)] + random_state.randn(n, n_features)
+
+
+def peak_rss_bytes():
+    """Returns the peak resident memory of the current process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PeakRSSSampler(object):
+    """Samples the resident memory of the current process and of all its children (e.g. the workers of the
+    'processes' backend) every interval seconds in a background thread, and keeps the peak of their sum. getrusage
+    cannot measure this total: it only reports children that already exited, and the maximum of each of them rather
+    than their sum. Sampling requires psutil, without it only the current process is measured.
+
+    Parameters
+    ----------
+    interval : float (optional, default=0.05)
+        Seconds between two samples.
+
+    Attributes
+    ----------
+    peak : int
+        The peak resident memory in bytes, available once the sampler is stopped.
+    includes_children : bool
+        Whether the children are included in the peak, i.e. whether psutil is available.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        try:
+            import psutil
+            self._process = psutil.Process()
+            self.includes_children = True
+        except ImportError:
+            self._process = None
+            self.includes_children = False
+
+    def sample(self):
+        import psutil
+
+        total = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                total = total + child.memory_info().rss
+            except psutil.NoSuchProcess:
+                # the child exited in the meantime
+                pass
+        self.peak = max(self.peak, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if self._process is not None:
+            self.sample()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.sample()
+        # the samples can miss a short spike of the current process, which getrusage records
+        self.peak = max(self.peak, peak_rss_bytes())
+        return False
+
+
+def exp_options_for(config):
+    """Builds the exp_options of squeak and disqueak for a run.
+
+    Parameters
+    ----------
+    config : mapping of string to any
+        The parameters of the run.
+
+    Returns
+    -------
+    exp_options : mapping of string to any
+        The experiment options.
+    """
+    return {'qbar': 2,
+            'gamma': config['gamma'],
+            'vareps': 0.3,
+            'max_dict_size': config['max_dict_size'],
+            'kernel_options': KERNELS[config['kernel']],
+            'rpc_invoker_options': BACKENDS[config['backend']],
+            'merge_schedule': 'dynamic' if config['shape'] == 'dynamic' else 'tree',
+            # leave room for the dictionaries to grow above the initial chunk size
+            'max_merge_size': 4 * config['max_dict_size'],
+            'poll_interval': 0.01}
+
+
+def run_one(config):
+    """Executes a single run, meant to be called in a fresh process.
+
+    Parameters
+    ----------
+    config : mapping of string to any
+        The parameters of the run.
+
+    Returns
+    -------
+    result : mapping of string to any
+        The parameters of the run, together with 'wall_time' (seconds), 'peak_rss' (bytes, see PeakRSSSampler),
+        'peak_rss_includes_workers', 'start_method', 'dict_size' and 'error'.
+    """
+    # the run is executed in a spawned process, which would also spawn the workers of the processes backend and
+    # time the import of numpy, scipy and sklearn in each of them. Fork them instead where it is safe to.
+    if sys.platform.startswith('linux'):
+        multiprocessing.set_start_method('fork', force=True)
+
+    sampler = PeakRSSSampler()
+    with sampler:
+        result = run_sampled(config)
+
+    result['peak_rss'] = sampler.peak
+    result['peak_rss_includes_workers'] = sampler.includes_children
+    result['start_method'] = multiprocessing.get_start_method()
+    return result
+
+
+def run_sampled(config):
+    """Executes the body of a run, see run_one."""
+    random_state = np.random.RandomState(0)
+    X = make_data(config['n'], config['n_features'], random_state)
+    exp_options = exp_options_for(config)
+
+    result = dict(config)
+    result['error'] = None
+    result['dict_size'] = None
+
+    try:
+        # silence the progress printed by the merges
+        with contextlib.redirect_stdout(io.StringIO()):
+            if config['benchmark'] in ('squeak', 'disqueak'):
+                algorithm = squeak.squeak if config['benchmark'] == 'squeak' else squeak.disqueak
+                start = time.perf_counter()
+                d = algorithm(X, exp_options, np.random.RandomState(1)).result
+                result['wall_time'] = time.perf_counter() - start
+            elif config['benchmark'] == 'dict_merge':
+                # merge two leaves of max_dict_size samples each
+                m = config['max_dict_size']
+                d_left = squeak.leaf_dict(X, np.arange(m), exp_options)
+                d_right = squeak.leaf_dict(X, np.arange(m, 2 * m), exp_options)
+
+                start = time.perf_counter()
+                d = squeak.dict_merge(d_left, d_right, exp_options['kernel_options'], np.random.RandomState(1))
+                result['wall_time'] = time.perf_counter() - start
+            else:
+                # the RLS of a dictionary as large as the input of a merge
+                d = squeak.leaf_dict(X, np.arange(2 * config['max_dict_size']), exp_options)
+
+                start = time.perf_counter()
+                squeak.estimate_tau(d, exp_options['kernel_options'])
+                result['wall_time'] = time.perf_counter() - start
+
+        result['dict_size'] = len(d.q_i)
+    except (AssertionError, np.linalg.LinAlgError) as e:
+        # e.g. a dictionary grew above max_dict_size for a too small gamma
+        result['wall_time'] = None
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+
+    return result
+
+
+def iter_configs(grid):
+    """Enumerates the runs of a grid. dict_merge and estimate_tau do not depend on n, the tree shape or the backend,
+    so they are run once for each of the other parameters.
+
+    Parameters
+    ----------
+    grid : mapping of string to list
+        The values of each parameter.
+
+    Yields
+    ------
+    config : mapping of string to any
+        The parameters of a run.
+    """
+    for n, n_features, max_dict_size, gamma, kernel in itertools.product(
+            grid['n'], grid['n_features'], grid['max_dict_size'], grid['gamma'], grid['kernel']):
+        base = {'n': n, 'n_features': n_features, 'max_dict_size': max_dict_size, 'gamma': gamma, 'kernel': kernel}
+
+        for shape, backend in itertools.product(grid['shape'], grid['backend']):
+            # the sequential tree has no parallelism to exploit
+            if shape == 'sequential' and backend != 'sync':
+                continue
+            yield dict(base, benchmark='squeak' if shape == 'sequential' else 'disqueak', shape=shape,
+                       backend=backend)
+
+    for n_features, max_dict_size, gamma, kernel in itertools.product(
+            grid['n_features'], grid['max_dict_size'], grid['gamma'], grid['kernel']):
+        for benchmark in ('dict_merge', 'estimate_tau'):
+            yield {'benchmark': benchmark, 'n': 2 * max_dict_size, 'n_features': n_features,
+                   'max_dict_size': max_dict_size, 'gamma': gamma, 'kernel': kernel, 'shape': None, 'backend': 'sync'}
+
+
+def environment():
+    """Describes the machine and the numerical libraries, stored with each result."""
+    import scipy
+    import sklearn
+
+    env = {'hostname': socket.gethostname(),
+           'platform': platform.platform(),
+           'python': platform.python_version(),
+           'cpu_count': os.cpu_count(),
+           'numpy': np.__version__,
+           'scipy': scipy.__version__,
+           'sklearn': sklearn.__version__}
+
+    try:
+        from threadpoolctl import threadpool_info
+        env['blas'] = ["{} {} ({} threads)".format(info.get('internal_api'), info.get('version'),
+                                                   info.get('num_threads'))
+                       for info in threadpool_info() if info.get('user_api') == 'blas']
+    except ImportError:
+        env['blas'] = None
+
+    return env
+
+
+def config_key(result):
+    return tuple(result[key] for key in CONFIG_KEYS)
+
+
+def load_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def add_speedups(results):
+    """Adds to each run of disqueak the 'speedup' of its wall time over the same run with the sync backend.
+
+    Parameters
+    ----------
+    results : list of mapping of string to any !!MODIFIED!!
+        The results of the runs.
+    """
+    serial = {config_key(dict(result, backend='sync')): result['wall_time']
+              for result in results if result['backend'] == 'sync'}
+
+    for result in results:
+        serial_time = serial.get(config_key(dict(result, backend='sync')))
+        if serial_time is not None and result['wall_time'] is not None:
+            result['speedup'] = serial_time / result['wall_time']
+        else:
+            result['speedup'] = None
+
+
+def format_table(results):
+    header = CONFIG_KEYS + ('wall_time', 'speedup', 'peak_rss_mb', 'dict_size')
+    rows = [header]
+    for result in results:
+        row = [result[key] for key in CONFIG_KEYS]
+        row.append("{:.3f}".format(result['wall_time']) if result['wall_time'] is not None else result['error'])
+        row.append("{:.2f}".format(result['speedup']) if result.get('speedup') is not None else '')
+        row.append("{:.0f}".format(result['peak_rss'] / 2 ** 20))
+        row.append(result['dict_size'])
+        rows.append(["" if value is None else str(value) for value in row])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+
+
+def run(args):
+    grid = dict(QUICK_GRID if args.quick else DEFAULT_GRID)
+    for key in grid:
+        if getattr(args, key) is not None:
+            grid[key] = getattr(args, key)
+
+    env = environment()
+    results = []
+
+    # spawn a new interpreter for each run, so that the peak memory is measured from scratch
+    context = multiprocessing.get_context('spawn')
+    with open(args.output, 'a') as f:
+        for config in iter_configs(grid):
+            for repeat in range(args.repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_one, config).result()
+                result['repeat'] = repeat
+                result['timestamp'] = time.time()
+                result['environment'] = env
+
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                results.append(result)
+
+                print(" ".join("{}={}".format(key, config[key]) for key in CONFIG_KEYS),
+                      "->", result['wall_time'] if result['error'] is None else result['error'])
+
+    add_speedups(results)
+    print(format_table(results))
+
+
+def report(args):
+    results = load_results(args.results)
+    add_speedups(results)
+    print(format_table(results))
+
+
+def compare(args):
+    """Compares the best wall time of each run between two result files, and exits with an error if any run is slower
+    than threshold times the baseline."""
+    def best_times(results):
+        best = {}
+        for result in results:
+            if result['wall_time'] is not None:
+                key = config_key(result)
+                best[key] = min(best.get(key, np.inf), result['wall_time'])
+        return best
+
+    baseline = best_times(load_results(args.baseline))
+    current = best_times(load_results(args.results))
+
+    regressions = 0
+    for key in sorted(set(baseline) & set(current), key=str):
+        ratio = current[key] / baseline[key]
+        flag = ''
+        if ratio > args.threshold:
+            flag = 'REGRESSION'
+            regressions = regressions + 1
+        print(" ".join("{}={}".format(name, value) for name, value in zip(CONFIG_KEYS, key)),
+              "{:.3f} -> {:.3f} ({:.2f}x) {}".format(baseline[key], current[key], ratio, flag))
+
+    missing = set(baseline) ^ set(current)
+    if missing:
+        print("{} runs are only present in one of the files".format(len(missing)))
+
+    sys.exit(1 if regressions > 0 else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks and append the results to a file')
+    run_parser.add_argument('--output', required=True, help='JSON lines file where the results are appended')
+    run_parser.add_argument('--quick', action='store_true', help='run a small grid, e.g. as a smoke test')
+    run_parser.add_argument('--repeat', type=int, default=1, help='number of repetitions of each run')
+    run_parser.add_argument('--n', type=int, nargs='+')
+    run_parser.add_argument('--n-features', type=int, nargs='+')
+    run_parser.add_argument('--max-dict-size', type=int, nargs='+')
+    run_parser.add_argument('--gamma', type=float, nargs='+')
+    run_parser.add_argument('--kernel', nargs='+', choices=sorted(KERNELS))
+    run_parser.add_argument('--shape', nargs='+', choices=SHAPES)
+    run_parser.add_argument('--backend', nargs='+', choices=sorted(BACKENDS))
+    run_parser.set_defaults(func=run)
+
+    report_parser = subparsers.add_parser('report', help='print the results stored in a file')
+    report_parser.add_argument('results')
+    report_parser.set_defaults(func=report)
+
+    compare_parser = subparsers.add_parser('compare', help='compare the wall times of two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=1.2,
+                                help='slowdown ratio above which a run is reported as a regression')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()